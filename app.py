@@ -1,21 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from datetime import datetime
 import logging
 from typing import Optional
 import uvicorn
 import os
 from time import sleep
-from collections import deque
 from fastapi import FastAPI, Form, Request, status
 from fastapi.responses import (
     HTMLResponse,
+    PlainTextResponse,
     RedirectResponse,
     StreamingResponse,
 )
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from modules.colorgrabber import ColorGrabber, RainbowGrabber, CameraGrabber
+from modules.metrics import metrics
 from modules.utils import config, save_config
 
 log = logging.getLogger(__name__)
@@ -133,7 +135,7 @@ def colors_cmd(cmd: str):
 
 
 @app.get('/stream')
-async def stream():
+def stream():
     color_grabber = get_instance(CameraGrabber)
     return StreamingResponse(
         color_grabber.stream(), media_type='multipart/x-mixed-replace; boundary=frame'
@@ -240,7 +242,48 @@ def saturation_down():
 
 @app.get('/dt')
 def dt():
-    return {'dt': CameraGrabber().server.dt}
+    server = CameraGrabber().server
+    return {
+        'dt': server.dt,
+        'fps': server.fps,
+        'coalesced': server.coalesced,
+        'lag': server.lag,
+        'idle': server.idle,
+    }
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.to_prometheus()
+
+
+@app.get('/metrics/json')
+def get_metrics_json():
+    return metrics.to_dict()
+
+
+@app.get('/camera')
+def camera():
+    return get_instance(CameraGrabber).camera.stats
+
+
+@app.get('/record/start')
+def record_start(filename: str = None):
+    filename = filename or datetime.now().strftime('recording_%Y%m%d_%H%M%S.rec')
+    get_instance(CameraGrabber).start_recording(filename)
+    return {'file': filename}
+
+
+@app.get('/record/stop')
+def record_stop():
+    recorder = get_instance(CameraGrabber).stop_recording()
+    if recorder is None:
+        return 'not recording'
+    return {
+        'file': recorder.filename,
+        'frames': recorder.count,
+        'dropped': recorder.dropped,
+    }
 
 
 @app.get('/wb')
@@ -249,9 +292,9 @@ def wb():
     if color_grabber.wb_correction is None:
         return 'automatic white balance correction is disabled'
     return dict(
-        red=float(color_grabber.wb_correction[0]),
+        red=float(color_grabber.wb_correction[2]),
         green=float(color_grabber.wb_correction[1]),
-        blue=float(color_grabber.wb_correction[2]),
+        blue=float(color_grabber.wb_correction[0]),
     )
 
 
@@ -260,8 +303,7 @@ def set_wb_frames(val: int):
     color_grabber = get_instance(CameraGrabber)
     config.colors['queueSize'] = val
     save_config()
-    color_grabber.last_wb_corrections = deque(maxlen=config.colors.get('queueSize', 30))
-    color_grabber.last_wb_weights = deque(maxlen=config.colors.get('queueSize', 30))
+    color_grabber.reset_wb(val)
     return RedirectResponse('/')
 
 
@@ -296,7 +338,7 @@ def window(cmd: str):
     if cmd == 'uu':
         config.window['bottom'] += 5
     save_config()
-    get_instance(CameraGrabber).indices = None
+    get_instance(CameraGrabber).reset_indices()
     return RedirectResponse('/')
 
 
@@ -319,7 +361,7 @@ def checkwindow(cmd: str):
     if cmd == 'uu':
         config.checkWindow['bottom'] += 5
     save_config()
-    get_instance(CameraGrabber)._check_indices = None
+    get_instance(CameraGrabber).reset_indices()
     return RedirectResponse('/')
 
 
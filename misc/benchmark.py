@@ -0,0 +1,130 @@
+"""
+offline throughput benchmark: synthetic camera -> CameraGrabber -> null sink.
+needs neither a webcam nor a tv nor an arduino.
+
+    python misc/benchmark.py --leds 300 --width 640 --height 480 --seconds 10
+    python misc/benchmark.py --zones 10 --crop --threaded
+    python misc/benchmark.py --file some_video.mp4
+"""
+
+import argparse
+import os
+import sys
+import tracemalloc
+from time import sleep
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AMBICAM_CONFIG', os.path.join(ROOT, 'config.json.sample'))
+
+parser = argparse.ArgumentParser(description='ambicam pipeline benchmark')
+parser.add_argument('--leds', type=int, default=300)
+parser.add_argument('--width', type=int, default=640)
+parser.add_argument('--height', type=int, default=480)
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--fps', type=float, default=0, help='camera fps, 0 = unlimited')
+parser.add_argument('--file', help='video or image instead of gradients')
+parser.add_argument('--zones', type=int, default=0, help='zone depth, 0 = pixels')
+parser.add_argument('--crop', action='store_true')
+parser.add_argument('--scale', type=float, default=1)
+parser.add_argument('--threaded', action='store_true')
+parser.add_argument('--interpolation', type=int, default=0)
+parser.add_argument('--smoothing', type=float, help='default: from config')
+parser.add_argument(
+    '--scene-cut', type=float, default=0, help='scene cut threshold, 0 = off'
+)
+
+
+def leds(num_leds, width, height):
+    # distribute the leds around the window proportional to the side lengths
+    from modules.utils import AttrDict
+
+    sides = [('bottom', width), ('right', height), ('top', width), ('left', height)]
+    total = 2 * (width + height)
+    result = []
+    for side, length in sides:
+        count = max(1, round(num_leds * length / total))
+        result.append(AttrDict(side=side, leds=count, **{'from': 0, 'to': 1}))
+    result[-1]['leds'] += num_leds - sum(_['leds'] for _ in result)
+    return result
+
+
+def configure(args, **synthetic):
+    "synthetic camera and null sink. call before importing modules.colorgrabber"
+    from modules.utils import AttrDict, config
+
+    config.cameraInterface = 'synthetic'
+    config.server = 'null'
+    config.tv = AttrDict()
+    config.synthetic = AttrDict(file=args.file, fps=args.fps, **synthetic)
+    config.resolution = AttrDict(width=args.width, height=args.height)
+    config.window = AttrDict(
+        left=args.width // 5,
+        top=args.height // 5,
+        right=args.width * 4 // 5,
+        bottom=args.height * 4 // 5,
+    )
+    config.leds = leds(args.leds, args.width, args.height)
+    config.zones = AttrDict(depth=args.zones)
+    config.capture = AttrDict(crop=args.crop, scale=args.scale, threaded=args.threaded)
+    config.fps = AttrDict(capture=args.fps or 30, interpolation=args.interpolation)
+    config.sceneCut = AttrDict(threshold=args.scene_cut)
+    if args.smoothing is not None:
+        config.smoothing = args.smoothing
+
+
+def print_stages(report):
+    print(f'{"stage":<12}{"count":>8}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}')
+    for name, stage in report.items():
+        print(
+            f'{name:<12}{stage["count"]:>8}{stage["p50"] * 1e3:>10.3f}'
+            f'{stage["p90"] * 1e3:>10.3f}{stage["p99"] * 1e3:>10.3f}'
+        )
+
+
+def main():
+    parser.add_argument('--frames', type=int, default=200, help='frames to profile')
+    args = parser.parse_args()
+    configure(args)
+
+    from modules.colorgrabber import CameraGrabber, ColorGrabber
+    from modules.metrics import metrics
+
+    grabber = CameraGrabber()
+    metrics.reset()
+    sent = grabber.server.frames
+    sleep(args.seconds)
+    sent = grabber.server.frames - sent
+    report = metrics.to_dict()
+
+    # stop the grabber thread but keep the camera, then profile from here
+    grabber.running = False
+    while ColorGrabber._instance is not None:
+        sleep(0.01)
+    transient = 0
+    grabber.get_colors()
+    for _ in range(args.frames):
+        # a fresh start clears traces and peak, reset_peak needs python 3.9
+        tracemalloc.start()
+        grabber.get_colors()
+        transient += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    # before teardown, it stops the capture thread that counts the drops
+    camera_stats = grabber.camera.stats
+    grabber.teardown()
+
+    print(
+        f'{args.leds} leds, {args.width}x{args.height}, zones={args.zones}, '
+        f'crop={args.crop}, scale={args.scale}, threaded={args.threaded}'
+    )
+    print(f'grabber: {report["frame"]["count"] / args.seconds:8.1f} frames/s')
+    print(f'sink:    {sent / args.seconds:8.1f} frames/s')
+    print_stages(report)
+    print(
+        f'allocated:   {transient / args.frames / 1024:8.1f} KiB/frame (peak, transient)'
+    )
+    print(f'camera:      {camera_stats}')
+
+
+if __name__ == '__main__':
+    main()
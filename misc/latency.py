@@ -0,0 +1,81 @@
+"""
+glass to led latency with a synthetic step change.
+the camera switches between dark and bright every --period seconds, the sink
+records when the leds cross 50 % and 90 % of every step. this includes capture,
+smoothing, interpolation and pacing, but not the wire to the strip.
+
+    python misc/latency.py --smoothing 0.95
+    python misc/latency.py --smoothing 0.5 --interpolation 4 --fps 30
+    python misc/latency.py --smoothing 0.95 --scene-cut 0.2
+"""
+
+from math import ceil
+from time import perf_counter as time, sleep
+from numpy import array, percentile
+from benchmark import configure, parser, print_stages
+
+
+def crossings(samples, steps, fraction):
+    "seconds from every step until the output crossed `fraction` of it"
+    result = []
+    for start, end in zip(steps, steps[1:]):
+        before = samples[(samples[:, 0] < start)]
+        during = samples[(samples[:, 0] >= start) & (samples[:, 0] < end)]
+        if not len(before) or not len(during):
+            continue
+        low, high = before[-1, 1], during[-1, 1]
+        level = low + fraction * (high - low)
+        crossed = (during[:, 1] >= level) if high > low else (during[:, 1] <= level)
+        if crossed.any():
+            result.append(during[crossed.argmax(), 0] - start)
+    return array(result)
+
+
+def main():
+    parser.set_defaults(fps=30)
+    parser.add_argument('--period', type=float, default=2, help='seconds per step')
+    parser.add_argument('--steps', type=int, default=10)
+    args = parser.parse_args()
+    configure(args, pattern='step', period=args.period)
+
+    from modules.colorgrabber import CameraGrabber
+    from modules.metrics import metrics
+    from modules.utils import config
+
+    samples = []
+    grabber = CameraGrabber()
+    grabber.server.on_send = lambda colors: samples.append(
+        (time(), float(array(colors).mean()))
+    )
+    metrics.reset()
+    # measure the steps after the first one we have seen settle
+    first = ceil((time() - grabber.camera.started) / args.period) + 1
+    steps = [
+        grabber.camera.started + (first + i) * args.period
+        for i in range(args.steps + 1)
+    ]
+    sleep(steps[-1] - time())
+    report = metrics.to_dict()
+    grabber.stop()
+
+    samples = array(samples)
+    print(
+        f'{args.leds} leds, smoothing={config.smoothing}, '
+        f'interpolation={args.interpolation}, scene cut={args.scene_cut}, '
+        f'camera {args.fps} fps'
+    )
+    for fraction in (0.5, 0.9):
+        values = crossings(samples, steps, fraction)
+        if not len(values):
+            print(f'{fraction:.0%}: no step settled, try a longer --period')
+            continue
+        p50, p90, p99 = percentile(values, [50, 90, 99]) * 1e3
+        print(
+            f'step to {fraction:.0%}: p50 {p50:.1f} ms, p90 {p90:.1f} ms, '
+            f'p99 {p99:.1f} ms, max {values.max() * 1e3:.1f} ms ({len(values)} steps)'
+        )
+    print_stages(report)
+
+
+if __name__ == '__main__':
+    main()
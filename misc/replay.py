@@ -0,0 +1,83 @@
+"""
+replays a recording (see modules/recording.py) through CameraGrabber as fast
+as possible, with the config it was recorded with, and compares the led
+colors with the recorded ones. shows whether a pipeline change keeps the
+output and how fast the same scene runs.
+
+    python misc/replay.py recording_20240101_200000.rec
+    python misc/replay.py some.rec --tolerance 0 --current-config
+"""
+
+import argparse
+import os
+import sys
+from time import sleep, perf_counter as time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AMBICAM_CONFIG', os.path.join(ROOT, 'config.json.sample'))
+
+from benchmark import print_stages
+
+parser = argparse.ArgumentParser(description='ambicam replay and output check')
+parser.add_argument('file')
+parser.add_argument(
+    '--tolerance', type=float, default=0.5, help='max difference per channel, 0 - 255'
+)
+parser.add_argument(
+    '--current-config',
+    action='store_true',
+    help='use AMBICAM_CONFIG instead of the recorded config',
+)
+
+
+def main():
+    args = parser.parse_args()
+
+    from numpy import absolute, asarray
+    from modules.recording import Recording
+    from modules.utils import AttrDict, config
+
+    recording = Recording(args.file)
+    if not args.current_config:
+        for key, value in recording.config.items():
+            config[key] = value
+    config.cameraInterface = 'replay'
+    config.server = 'null'
+    config.tv = AttrDict()
+    config.replay = AttrDict(file=args.file, speed=0, loop=True)
+    # frames in order, one per get_colors
+    config.capture = AttrDict(config.capture or {}, threaded=False)
+
+    from modules.colorgrabber import CameraGrabber, ColorGrabber
+    from modules.metrics import metrics
+
+    # stop the grabber thread but keep the camera, then replay from the start
+    grabber = CameraGrabber()
+    grabber.running = False
+    while ColorGrabber._instance is not None:
+        sleep(0.01)
+    grabber.camera.index = 0
+    grabber.reset_state()
+    metrics.reset()
+
+    worst, mismatches = 0, 0
+    elapsed = 0
+    for expected in recording.leds:
+        t = time()
+        colors = grabber.get_colors()
+        elapsed += time() - t
+        diff = absolute(asarray(colors, dtype=float) - expected).max()
+        worst = max(worst, diff)
+        mismatches += diff > args.tolerance
+    grabber.teardown()
+
+    print(f'{len(recording)} frames, {recording.header["shape"]} band')
+    print(f'replay:      {len(recording) / elapsed:8.1f} frames/s')
+    print_stages(metrics.to_dict())
+    print(f'max difference: {worst:.3f}, frames above {args.tolerance}: {mismatches}')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
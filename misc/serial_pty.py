@@ -0,0 +1,96 @@
+"""
+checks SerialConnection against a pty that drains like a serial line: the
+frames sent per second have to stay within what the line carries, so no
+backlog builds up between ambicam and the arduino. exits 1 otherwise.
+
+    python misc/serial_pty.py --leds 100 --baudrate 115200 --seconds 3
+"""
+
+import argparse
+import os
+import pty
+import sys
+import threading
+import tty
+from time import sleep, perf_counter as time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AMBICAM_CONFIG', os.path.join(ROOT, 'config.json.sample'))
+
+parser = argparse.ArgumentParser(description='SerialConnection pacing on a pty')
+parser.add_argument('--leds', type=int, default=100)
+parser.add_argument('--baudrate', type=int, default=115200)
+parser.add_argument('--seconds', type=float, default=3)
+parser.add_argument('--fps', type=float, default=200, help='frames published')
+
+
+def drain(fd, baudrate, received, running):
+    "reads from the pty no faster than the line would carry the bytes"
+    budget, last = 0, time()
+    while running.is_set():
+        sleep(0.002)
+        now = time()
+        # no credit for the time the line was idle
+        budget = min(budget + (now - last) * baudrate / 10, baudrate / 100)
+        last = now
+        try:
+            data = os.read(fd, int(budget))
+        except (BlockingIOError, OSError):
+            continue
+        received.extend(data)
+        budget -= len(data)
+
+
+def main():
+    args = parser.parse_args()
+
+    from numpy import full, uint8
+    from modules.adalight import frame_interval, frame_size
+    from modules.servers import SerialConnection
+
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    # the sketch greets once it listens
+    os.write(master, b'Ada\n')
+    received = bytearray()
+    running = threading.Event()
+    running.set()
+    reader = threading.Thread(
+        target=drain, args=(master, args.baudrate, received, running), daemon=True
+    )
+    reader.start()
+
+    connection = SerialConnection()
+    connection.connect(port=os.ttyname(slave), baudrate=args.baudrate)
+    sleep(0.1)
+    start, before = time(), len(received)
+    published = 0
+    while time() - start < args.seconds:
+        connection.update_colors(full((args.leds, 3), published % 256, uint8))
+        published += 1
+        sleep(1 / args.fps)
+    # everything still queued in the pty shows up as latency
+    elapsed = time() - start
+    drained = (len(received) - before) / frame_size(args.leds) / elapsed
+    connection.stop()
+    sleep(0.5)
+    running.clear()
+
+    line_fps = 1 / frame_interval(args.leds, args.baudrate)
+    backlog = connection.fps / line_fps
+    print(
+        f'{args.leds} leds at {args.baudrate} baud: line {line_fps:.1f} fps, '
+        f'sent {connection.fps:.1f} fps, drained {drained:.1f} fps, '
+        f'published {published / elapsed:.1f} fps'
+    )
+    if connection.fps > line_fps * 1.05:
+        print(f'FAIL: sending {backlog:.2f}x faster than the line')
+        sys.exit(1)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
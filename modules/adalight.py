@@ -0,0 +1,63 @@
+"""
+adalight wire format as parsed by arduino_server/arduino_server.ino:
+'Ada' + led count - 1 (hi, lo) + checksum (hi ^ lo ^ 0x55) + 3 bytes per led
+"""
+
+from numpy import asarray, clip, copyto, empty, frombuffer, take, uint8
+
+MAGIC = b'Ada'
+HEADER_SIZE = 6
+# bgr -> grb, the byte order the strip expects
+ORDER = [1, 2, 0]
+
+
+def header(num_leds):
+    num = num_leds - 1
+    hi = num >> 8
+    lo = num & 0xFF
+    return MAGIC + bytes([hi, lo, hi ^ lo ^ 0x55])
+
+
+def frame_size(num_leds):
+    return HEADER_SIZE + 3 * num_leds
+
+
+def frame_interval(num_leds, baudrate):
+    """
+    minimum seconds between two frames: the serial transfer (8N1) plus the
+    latch. the sketch flushes its serial buffer after FastLED.show(), so bytes
+    arriving while a ws2812b strip latches (30 us per led + 50 us reset) are lost.
+    """
+    return frame_size(num_leds) * 10 / baudrate + latch_time(num_leds)
+
+
+def latch_time(num_leds):
+    "seconds a ws2812b strip needs to take over a frame"
+    return num_leds * 30e-6 + 50e-6
+
+
+class FrameEncoder:
+    "encodes bgr colors into one preallocated adalight frame"
+
+    num_leds = None
+
+    def _allocate(self, num_leds):
+        self.buffer = bytearray(frame_size(num_leds))
+        self.buffer[:HEADER_SIZE] = header(num_leds)
+        self.view = memoryview(self.buffer)
+        self.payload = frombuffer(self.buffer, dtype=uint8, offset=HEADER_SIZE)
+        self.payload = self.payload.reshape(num_leds, 3)
+        self._scratch = empty((num_leds, 3))
+        self.num_leds = num_leds
+
+    def encode(self, colors) -> memoryview:
+        colors = asarray(colors)
+        if len(colors) != self.num_leds:
+            self._allocate(len(colors))
+        if colors.dtype == uint8:
+            take(colors, ORDER, axis=1, out=self.payload)
+        else:
+            take(colors.astype(float, copy=False), ORDER, axis=1, out=self._scratch)
+            clip(self._scratch, 0, 255, out=self._scratch)
+            copyto(self.payload, self._scratch, casting='unsafe')
+        return self.view
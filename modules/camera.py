@@ -1,12 +1,98 @@
 from abc import ABC, abstractmethod
-from numpy import ndarray
-from time import sleep
+import threading
+from typing import Optional
+from numpy import copyto, linspace, ndarray, uint8, zeros
+from time import sleep, perf_counter as time
 import cv2
+from modules.recording import Recording
 from modules.utils import config
 from os import system
 
 
+class FrameRing(threading.Thread):
+    """
+    reads frames in the background into a few preallocated buffers.
+    the consumer always gets the newest frame, never one it has seen before.
+    """
+
+    def __init__(self, camera, size=3):
+        super().__init__(daemon=True)
+        self.camera = camera
+        self.buffers = [None] * size
+        self.times = [0] * size
+        self.seq = 0
+        self.latest = None
+        self.reading = None
+        self.dropped = 0
+        self.duplicates = 0
+        self._last_seq = 0
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            with self._condition:
+                # never overwrite the newest frame or the one being processed
+                slot = next(
+                    i
+                    for i in range(len(self.buffers))
+                    if i not in (self.latest, self.reading)
+                )
+            frame = self.camera.read_frame(self.buffers[slot])
+            if frame is None:
+                sleep(0.01)
+                continue
+            with self._condition:
+                self.buffers[slot] = frame
+                self.times[slot] = time()
+                self.latest = slot
+                self.seq += 1
+                self._condition.notify_all()
+            if self.camera.throttle:
+                self._wake.wait(self.camera.throttle)
+                self._wake.clear()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        self.join(timeout=1)
+
+    def get(self, timeout=1):
+        "(newest frame, capture time)"
+        with self._condition:
+            if self._condition.wait_for(lambda: self.seq > self._last_seq, timeout):
+                self.dropped += self.seq - self._last_seq - 1
+            else:
+                self.duplicates += 1
+            self._last_seq = self.seq
+            self.reading = self.latest
+            if self.latest is None:
+                return None, None
+            return self.buffers[self.latest], self.times[self.latest]
+
+
 class AbstractCamera(ABC):
+    # (top, left, bottom, right) of the captured band in full frame coordinates
+    roi = None
+    scale = 1
+    raw_frame = None
+    # perf_counter timestamp of the capture of the current frame
+    frame_time = None
+    frame_seq = 0
+    duplicates = 0
+    # (roi, scale) the current frame was cropped with
+    band = None
+    # seconds the capture thread rests between frames, e.g. while idle
+    throttle = 0
+    _frame = None
+    _ring = None
+    # reused by read_frame when capture is not threaded
+    _buffer = None
+
     @abstractmethod
     def connect(self) -> bool:
         pass
@@ -16,20 +102,94 @@ class AbstractCamera(ABC):
         pass
 
     @abstractmethod
-    def get_frame(self) -> ndarray:
+    def read_frame(self, out: Optional[ndarray] = None) -> Optional[ndarray]:
+        "full uint8 bgr frame or None. reuses `out` as buffer if possible."
         pass
 
+    def start_capture(self):
+        if not (config.capture or {}).get('threaded'):
+            return
+        self._ring = FrameRing(self)
+        self._ring.start()
+
+    def stop_capture(self):
+        if self._ring is not None:
+            self._ring.stop()
+            self._ring = None
+
+    def set_throttle(self, seconds):
+        self.throttle = seconds
+        if self._ring is not None and not seconds:
+            self._ring.wake()
+
+    @property
+    def stats(self):
+        if self._ring is None:
+            return {
+                'frames': self.frame_seq,
+                'dropped': 0,
+                'duplicates': self.duplicates,
+            }
+        return {
+            'frames': self._ring.seq,
+            'dropped': self._ring.dropped,
+            'duplicates': self._ring.duplicates,
+        }
+
+    def get_frame(self) -> ndarray:
+        if self._ring is not None:
+            frame, frame_time = self._ring.get()
+            self.frame_seq = self._ring.seq
+        else:
+            frame = self.read_frame(self._buffer)
+            frame_time = time()
+            if frame is None:
+                self.duplicates += 1
+            else:
+                self._buffer = frame
+                self.frame_seq += 1
+        if frame is not None:
+            self.frame_time = frame_time
+            self.raw_frame = frame
+            self.band = (self.roi, self.scale)
+            self._frame = self.crop(frame)
+        return self._frame
+
+    def crop(self, frame):
+        if self.roi is not None:
+            top, left, bottom, right = self.roi
+            frame = frame[top:bottom, left:right]
+        if self.scale != 1:
+            height, width = self.band_shape
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        return frame
+
+    @property
+    def band_shape(self):
+        top, left, bottom, right = self.roi or (
+            0,
+            0,
+            config.resolution['height'],
+            config.resolution['width'],
+        )
+        return (
+            max(1, int(round((bottom - top) * self.scale))),
+            max(1, int(round((right - left) * self.scale))),
+        )
+
 
 class PiCamera(AbstractCamera):
     def connect(self):
         # should be installed by default on raspberry
         try:
             import picamera
+            import picamera.array
         except ModuleNotFoundError:
             raise ModuleNotFoundError(
                 'picamera not installed. '
                 'try: sudo apt install python-picamera python3-picamera'
             )
+        self.picamera = picamera
         self.vid = picamera.PiCamera()
         self.vid.resolution = (config.resolution['width'], config.resolution['height'])
         self.vid.framerate = config.fps.get('capture', 30)
@@ -38,20 +198,22 @@ class PiCamera(AbstractCamera):
         g = self.vid.awb_gains
         self.vid.awb_mode = 'off'
         self.vid.awb_gains = g
+        self.start_capture()
 
     def disconnect(self):
+        self.stop_capture()
         self.vid.close()
 
-    def get_frame(self):
-        with picamera.array.PiRGBArray(self.vid) as stream:
+    def read_frame(self, out=None):
+        with self.picamera.array.PiRGBArray(self.vid) as stream:
             self.vid.capture(stream, format='bgr')
-            frame = stream.array
-        return ndarray.astype(frame, dtype=float)
+            if out is None or out.shape != stream.array.shape:
+                return stream.array
+            copyto(out, stream.array)
+            return out
 
 
 class Cv2Camera(AbstractCamera):
-    _frame = None
-
     def connect(self):
         system('v4l2-ctl --set-ctrl=white_balance_auto_preset=0')
         system('v4l2-ctl --set-ctrl=red_balance=1500')
@@ -60,14 +222,145 @@ class Cv2Camera(AbstractCamera):
         self.vid.set(cv2.CAP_PROP_FRAME_WIDTH, config.resolution['width'])
         self.vid.set(cv2.CAP_PROP_FRAME_HEIGHT, config.resolution['height'])
         self.vid.set(cv2.CAP_PROP_FPS, config.fps.get('capture', 30))
+        # do not let the driver queue up stale frames
+        self.vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self.start_capture()
         return True
 
     def disconnect(self):
+        self.stop_capture()
         self.vid.release()
 
-    def get_frame(self):
-        success, frame = self.vid.read()
+    def read_frame(self, out=None):
+        success, frame = self.vid.read(out)
         if success:
-            frame = ndarray.astype(frame, dtype=float)
-            self._frame = frame
-        return self._frame
+            return frame
+
+
+class SyntheticCamera(AbstractCamera):
+    """
+    frames without a webcam, e.g. for misc/benchmark.py. loops the frames of
+    config.synthetic.file (video or image) or generated moving gradients.
+    pattern 'step' switches between dark and bright every `period` seconds,
+    starting at `started`, for misc/latency.py.
+    config.synthetic.fps limits the frame rate, 0 means as fast as possible.
+    """
+
+    def connect(self):
+        synthetic = config.synthetic or {}
+        fps = synthetic.get('fps', 0)
+        self.interval = 1 / fps if fps else 0
+        self.period = synthetic.get('period', 0)
+        if synthetic.get('pattern') == 'step':
+            self.frames = self._steps()
+        elif synthetic.get('file'):
+            self.frames = self._load(synthetic['file'])
+        else:
+            self.frames = self._gradients(synthetic.get('frames', 30))
+        self.index = 0
+        self._next = 0
+        self.started = time()
+        self.start_capture()
+        return True
+
+    def disconnect(self):
+        self.stop_capture()
+
+    def read_frame(self, out=None):
+        if self.interval:
+            wait = self._next - time()
+            if wait > 0:
+                sleep(wait)
+            self._next = max(self._next, time()) + self.interval
+        if self.period:
+            self.index = int((time() - self.started) / self.period)
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        if out is None or out.shape != frame.shape:
+            return frame.copy()
+        copyto(out, frame)
+        return out
+
+    @staticmethod
+    def _load(filename):
+        size = (config.resolution['width'], config.resolution['height'])
+        vid = cv2.VideoCapture(filename)
+        frames = []
+        success, frame = vid.read()
+        while success and len(frames) < 300:
+            frames.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+            success, frame = vid.read()
+        vid.release()
+        if not frames:
+            raise ValueError(f'No frames in {filename}')
+        return frames
+
+    @staticmethod
+    def _steps():
+        shape = (config.resolution['height'], config.resolution['width'], 3)
+        return [zeros(shape, dtype=uint8) + 16, zeros(shape, dtype=uint8) + 240]
+
+    @staticmethod
+    def _gradients(count):
+        height, width = config.resolution['height'], config.resolution['width']
+        xs = linspace(0, 255, width)[None, :]
+        ys = linspace(0, 255, height)[:, None]
+        frames = []
+        for i in range(count):
+            shift = 256 * i / count
+            frame = zeros((height, width, 3), dtype=uint8)
+            frame[..., 0] = (xs + shift) % 256
+            frame[..., 1] = (ys + 2 * shift) % 256
+            frame[..., 2] = (xs + ys + 3 * shift) % 256
+            frames.append(frame)
+        return frames
+
+
+class ReplayCamera(AbstractCamera):
+    """
+    plays the camera band of a recording (modules/recording.py) from
+    config.replay.file. speed 1 keeps the original timing, 0 is as fast as
+    possible. window, leds and capture have to match the recording.
+    """
+
+    def connect(self):
+        replay = config.replay or {}
+        self.recording = Recording(replay['file'])
+        if not len(self.recording):
+            raise ValueError(f'Empty recording: {replay["file"]}')
+        self.speed = replay.get('speed', 1)
+        self.loop = replay.get('loop', True)
+        self.index = 0
+        self.started = time()
+        self.start_capture()
+        return True
+
+    def disconnect(self):
+        self.stop_capture()
+
+    def read_frame(self, out=None):
+        if self.index >= len(self.recording):
+            if not self.loop:
+                return None
+            self.index = 0
+            self.started = time()
+        if self.speed:
+            wait = self.recording.times[self.index] / self.speed
+            wait -= time() - self.started
+            if wait > 0:
+                sleep(wait)
+        frame = self.recording.frames[self.index]
+        self.index += 1
+        if out is None or out.shape != frame.shape:
+            return frame.copy()
+        copyto(out, frame)
+        return out
+
+    def crop(self, frame):
+        # recorded frames are the band already
+        if frame.shape[:2] != self.band_shape:
+            raise ValueError(
+                f'Recorded band {frame.shape[:2]} does not match the configured '
+                f'window and capture settings {self.band_shape}'
+            )
+        return frame
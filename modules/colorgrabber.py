@@ -5,17 +5,43 @@ import os
 from random import gauss, randint
 from typing import Iterable
 import cv2
-from time import sleep
+from time import sleep, perf_counter as time
 from collections import deque
 import threading
-from numpy import apply_along_axis, array, convolve, linspace, average, zeros
-from modules.servers import BridgeConnection, PrismatikConnection, DummyConnection
+from numpy import (
+    absolute,
+    apply_along_axis,
+    array,
+    ceil,
+    concatenate,
+    convolve,
+    copyto,
+    empty_like,
+    flatnonzero,
+    floor,
+    int32,
+    intp,
+    linspace,
+    average,
+    maximum,
+    subtract,
+    zeros,
+)
+from modules.metrics import metrics
+from modules.pipeline import Pipeline
+from modules.preview import Preview
+from modules.recording import Recorder
+from modules.servers import CONNECTIONS
 from modules.utils import config, TV
 from abc import ABC, abstractmethod
 from random import randint
 
 if config.get('cameraInterface', 'cv2') == 'picamera':
     from modules.camera import PiCamera as Camera
+elif config.get('cameraInterface') == 'synthetic':
+    from modules.camera import SyntheticCamera as Camera
+elif config.get('cameraInterface') == 'replay':
+    from modules.camera import ReplayCamera as Camera
 else:
     from modules.camera import Cv2Camera as Camera
 
@@ -31,6 +57,12 @@ class BGRColor:
 class ColorGrabber(ABC, threading.Thread):
     _instance = None
     running = False
+    # capture time of the frame the last colors came from
+    frame_time = None
+    # the last colors start a new scene, skip the smoothing towards them
+    scene_cut = False
+    # the colors did not change for a while, capture and send less often
+    idle = False
 
     @abstractmethod
     def initialize(self):
@@ -65,22 +97,25 @@ class ColorGrabber(ABC, threading.Thread):
     def connect_to_server(self):
         log.debug("connect server")
         server_type = config.get('server', 'dummy')
-        if server_type not in config and server_type != 'dummy':
+        if server_type not in config and server_type not in ('dummy', 'null'):
             raise ValueError(f'Unknown server type: {server_type}')
-        if server_type == 'prismatik':
-            self.server = PrismatikConnection()
-        elif server_type == 'bridge':
-            self.server = BridgeConnection()
-        else:
-            self.server = DummyConnection()
+        self.server = CONNECTIONS.get(server_type, CONNECTIONS['dummy'])()
         self.server.connect(**config.get(server_type, {}))
 
     def run(self):
         self.running = True
         try:
             while self.running:
+                t = time()
                 colors = self.get_colors()
-                self.server.update_colors(colors)
+                if self.scene_cut:
+                    self.server.flush()
+                self.server.idle = self.idle
+                self.server.update_colors(colors, self.frame_time)
+                metrics.observe('frame', time() - t)
+                if self.idle:
+                    fps = (config.idle or {}).get('fps', 5)
+                    sleep(max(1 / fps - (time() - t), 0))
         finally:
             self.running = False
             self.server.stop()
@@ -89,16 +124,23 @@ class ColorGrabber(ABC, threading.Thread):
 
 
 class CameraGrabber(ColorGrabber):
-    _frame = None
     _indices = None
     _check_indices = None
-    _last_colors = None
+    _zones = None
+    _geometry = None
     auto_wb = False
     is_paused = False
     wb_queue_size = 30
     wb_correction = array([1, 1, 1])
     last_wb_corrections = deque(maxlen=150)
     last_wb_weights = deque(maxlen=150)
+    _wb_count = 0
+    _last_sample = None
+    scene_change = 0
+    scene_cuts = 0
+    _still_since = None
+    recorder = None
+    _next_recorder = None
 
     def initialize(self):
         log.debug('connect camera')
@@ -106,61 +148,76 @@ class CameraGrabber(ColorGrabber):
             os.system(f'v4l2-ctl --set-ctrl={property}={value}')
         self.camera = Camera()
         self.camera.connect()
+        self.preview = Preview(**(config.preview or {}))
+        self.pipeline = Pipeline()
         self.is_paused = False
         self.tv = TV(host=config.tv.host, dt=1)
-        self.last_wb_corrections = deque(maxlen=config.colors.get('queueSize', 150))
-        self.last_wb_weights = deque(maxlen=config.colors.get('queueSize', 150))
+        self.reset_wb(config.colors.get('queueSize', 150))
 
     @property
     def frame(self):
         if not self.running:
             return
-        frame = cv2.rectangle(
-            self._frame,
-            (config.window['left'], config.window['top']),
-            (config.window['right'], config.window['bottom']),
-            (0, 0, 255),
-            2,
-        )
+        return self.preview.request()
+
+    def overlays(self):
+        overlays = [
+            (
+                (
+                    config.window['left'],
+                    config.window['top'],
+                    config.window['right'],
+                    config.window['bottom'],
+                ),
+                (0, 0, 255),
+            )
+        ]
         if self.auto_wb:
-            frame = cv2.rectangle(
-                self._frame,
-                (config.checkWindow['left'], config.checkWindow['top']),
-                (config.checkWindow['right'], config.checkWindow['bottom']),
-                (255, 0, 0),
-                2,
+            overlays.append(
+                (
+                    (
+                        config.checkWindow['left'],
+                        config.checkWindow['top'],
+                        config.checkWindow['right'],
+                        config.checkWindow['bottom'],
+                    ),
+                    (255, 0, 0),
+                )
             )
-        return frame
-
-    @frame.setter
-    def frame(self, frame):
-        self._frame = frame
+        return overlays
 
     def save_frame(self, filepath):
         if self.is_paused:
             return
-        cv2.imwrite(filepath, self.frame)
-
-    def stream(self):
-        while self.running:
-            ret, buffer = cv2.imencode('.jpg', self.frame)
-            frame = buffer.tobytes()
-            yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n'
-            sleep(0.3)
+        jpeg = self.preview.request_jpeg()
+        if jpeg is not None:
+            with open(filepath, 'wb') as f:
+                f.write(jpeg)
+
+    async def stream(self):
+        # slow clients skip snapshots instead of queueing them
+        async for jpeg in self.preview.frames():
+            if not self.running:
+                break
+            if jpeg is None:
+                continue
+            yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
 
     @property
     def indices(self):
+        """cached (ys, xs) index arrays of the led pixels"""
         if self._indices is not None:
             return self._indices
 
-        indices = []
-        check_indices = []
+        ys, xs, boxes, sides = [], [], [], []
+        check_idx, check_ys, check_xs = [], [], []
         self.auto_wb = False
+        depth = (config.zones or {}).get('depth', 0)
 
         idx = -1
         for side in config.leds:
             if side['side'] in ('top', 'bottom'):
-                for x in linspace(
+                positions = linspace(
                     (
                         config.window['left']
                         + side['from']
@@ -171,17 +228,22 @@ class CameraGrabber(ColorGrabber):
                         + side['to'] * (config.window['right'] - config.window['left'])
                     ),
                     int(side['leds']),
-                ):
+                )
+                half = self._half_spacing(positions)
+                for x in positions:
                     idx += 1
-                    indices.append([int(config.window[side['side']]), int(x)])
+                    ys.append(int(config.window[side['side']]))
+                    xs.append(int(x))
+                    boxes.append(self._zone(side['side'], ys[-1], x, half, depth))
+                    sides.append(side['side'])
                     if side.get('check'):
                         self.auto_wb = True
-                        check_indices.append(
-                            [idx, int(config.checkWindow[side['side']]), int(x)]
-                        )
+                        check_idx.append(idx)
+                        check_ys.append(int(config.checkWindow[side['side']]))
+                        check_xs.append(int(x))
 
             if side['side'] in ('left', 'right'):
-                for y in linspace(
+                positions = linspace(
                     (
                         config.window['top']
                         + side['from']
@@ -192,21 +254,151 @@ class CameraGrabber(ColorGrabber):
                         + side['to'] * (config.window['bottom'] - config.window['top'])
                     ),
                     int(side['leds']),
-                ):
+                )
+                half = self._half_spacing(positions)
+                for y in positions:
                     idx += 1
-                    indices.append([int(y), int(config.window[side['side']])])
+                    ys.append(int(y))
+                    xs.append(int(config.window[side['side']]))
+                    boxes.append(self._zone(side['side'], y, xs[-1], half, depth))
+                    sides.append(side['side'])
                     if side.get('check'):
                         self.auto_wb = True
-                        check_indices.append(
-                            [idx, int(y), int(config.checkWindow[side['side']])]
-                        )
+                        check_idx.append(idx)
+                        check_ys.append(int(y))
+                        check_xs.append(int(config.checkWindow[side['side']]))
+
+        ys, xs = array(ys, dtype=intp), array(xs, dtype=intp)
+        check_ys, check_xs = array(check_ys, dtype=intp), array(check_xs, dtype=intp)
+        boxes = array(boxes, dtype=intp).reshape(-1, 4)
+        self._set_band(
+            concatenate([ys, boxes[:, 0], boxes[:, 2] - 1, check_ys]),
+            concatenate([xs, boxes[:, 1], boxes[:, 3] - 1, check_xs]),
+        )
 
-        self._indices = indices
-        self._check_indices = check_indices
+        self._check_indices = (
+            array(check_idx, dtype=intp),
+            *self._to_band(check_ys, check_xs),
+        )
+        if depth > 0:
+            y0, x0 = self._to_band(boxes[:, 0], boxes[:, 1])
+            y1, x1 = self._to_band(boxes[:, 2], boxes[:, 3], end=True)
+            y1, x1 = maximum(y1, y0 + 1), maximum(x1, x0 + 1)
+            self._zones = self._strips(array(sides), y0, x0, y1, x1)
+        else:
+            self._zones = None
+        self._indices = self._to_band(ys, xs)
+        self._geometry = (
+            *self._indices,
+            self._zones,
+            self._check_indices,
+            (self.camera.roi, self.camera.scale),
+        )
         return self._indices
 
+    def _set_band(self, ys, xs):
+        # only capture the bounding box of everything we sample
+        capture = config.capture or {}
+        self.camera.scale = capture.get('scale', 1)
+        if not capture.get('crop'):
+            self.camera.roi = None
+            return
+        self.camera.roi = (
+            int(ys.min()),
+            int(xs.min()),
+            int(ys.max()) + 1,
+            int(xs.max()) + 1,
+        )
+
+    def _to_band(self, ys, xs, end=False):
+        # map full frame coordinates onto the cropped and scaled camera band
+        top, left = (self.camera.roi or (0, 0))[:2]
+        height, width = self.camera.band_shape
+        scale = self.camera.scale
+        if end:
+            return (
+                ceil((ys - top) * scale).astype(intp).clip(1, height),
+                ceil((xs - left) * scale).astype(intp).clip(1, width),
+            )
+        return (
+            floor((ys - top) * scale).astype(intp).clip(0, height - 1),
+            floor((xs - left) * scale).astype(intp).clip(0, width - 1),
+        )
+
+    @staticmethod
+    def _half_spacing(positions):
+        if len(positions) < 2:
+            return 0.5
+        return max(abs(positions[1] - positions[0]) / 2, 0.5)
+
+    @staticmethod
+    def _zone(side, y, x, half, depth):
+        # [y0, x0, y1, x1) patch reaching `depth` pixels into the picture
+        width = config.resolution['width']
+        height = config.resolution['height']
+        if side in ('top', 'bottom'):
+            x0, x1 = int(round(x - half)), int(round(x + half))
+            y0, y1 = (y, y + depth) if side == 'top' else (y - depth + 1, y + 1)
+        else:
+            y0, y1 = int(round(y - half)), int(round(y + half))
+            x0, x1 = (x, x + depth) if side == 'left' else (x - depth + 1, x + 1)
+        y0, y1 = min(max(y0, 0), height - 1), min(max(y1, 1), height)
+        x0, x1 = min(max(x0, 0), width - 1), min(max(x1, 1), width)
+        return [y0, x0, max(y1, y0 + 1), max(x1, x0 + 1)]
+
+    @staticmethod
+    def _strips(sides, y0, x0, y1, x1):
+        """
+        ([per side: (bounding box, integral table, led idx, patches, area)],
+        colors buffer). only the strips along the sides get integrated.
+        """
+        strips = []
+        for side in sorted(set(sides)):
+            idx = flatnonzero(sides == side)
+            top, left = int(y0[idx].min()), int(x0[idx].min())
+            bottom, right = int(y1[idx].max()), int(x1[idx].max())
+            patches = (
+                y0[idx] - top,
+                x0[idx] - left,
+                y1[idx] - top,
+                x1[idx] - left,
+            )
+            area = ((y1[idx] - y0[idx]) * (x1[idx] - x0[idx]))[:, None]
+            table = zeros((bottom - top + 1, right - left + 1, 3), dtype=int32)
+            strips.append(((top, left, bottom, right), table, idx, patches, area))
+        return strips, zeros((len(sides), 3))
+
+    @property
+    def zones(self):
+        """cached strips of the led patches, see _strips, or None"""
+        self.indices
+        return self._zones
+
+    @property
+    def geometry(self):
+        """
+        (ys, xs, zones, check_indices, (roi, scale)) from one computation of
+        the indices, stays consistent even if the window changes meanwhile
+        """
+        geometry = self._geometry
+        if geometry is None:
+            self.indices
+            geometry = self._geometry
+        return geometry
+
+    def sample_zones(self, frame, zones):
+        # mean of every patch from the summed-area table of its side strip
+        strips, colors = zones
+        for (top, left, bottom, right), table, idx, patches, area in strips:
+            cv2.integral(frame[top:bottom, left:right], table)
+            y0, x0, y1, x1 = patches
+            sums = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+            colors[idx] = sums / area
+        return colors
+
     @property
     def check_indices(self):
+        """cached (led_idx, ys, xs) index arrays of the check pixels"""
         if self._check_indices is not None:
             return self._check_indices
 
@@ -220,6 +412,94 @@ class CameraGrabber(ColorGrabber):
     def indices(self, indices):
         self._indices = indices
 
+    @property
+    def num_leds(self):
+        return len(self.indices[0])
+
+    def reset_indices(self):
+        # call whenever window, checkWindow or leds change
+        self._indices = None
+        self._check_indices = None
+        self._zones = None
+        self._geometry = None
+
+    def reset_wb(self, queue_size):
+        # an empty queue could not hold the estimate it averages
+        queue_size = max(int(queue_size), 1)
+        self.last_wb_corrections = deque(maxlen=queue_size)
+        self.last_wb_weights = deque(maxlen=queue_size)
+        self._wb_sum = zeros(3)
+        self._wb_weight = 0.0
+
+    def update_wb(self, frame, colors, check_indices):
+        """
+        the wall around the tv (checkWindow) should show the colors of the
+        screen edge (window) that the leds in front of it display.
+        keeps a weighted average over the last queueSize estimates in O(1).
+        """
+        idx, ys, xs = check_indices
+        if not len(idx):
+            return
+        target = colors[idx].sum(axis=0)
+        observed = frame[ys, xs].sum(axis=0, dtype=float)
+        if observed.min() < 1 or target.min() < 1:
+            return
+        correction = target / observed
+        correction /= correction.mean()
+        # brighter walls give more reliable estimates
+        weight = observed.sum()
+        if len(self.last_wb_weights) == self.last_wb_weights.maxlen:
+            self._wb_sum -= self.last_wb_corrections[0] * self.last_wb_weights[0]
+            self._wb_weight -= self.last_wb_weights[0]
+        self.last_wb_corrections.append(correction)
+        self.last_wb_weights.append(weight)
+        self._wb_sum += correction * weight
+        self._wb_weight += weight
+        wb_correction = self._wb_sum / self._wb_weight
+        self.wb_correction = wb_correction / wb_correction.max()
+
+    def detect_scene_cut(self, colors):
+        # mean absolute change of the sampled colors since the last frame, 0 - 1
+        if self._last_sample is None or self._last_sample.shape != colors.shape:
+            self._last_sample = colors.copy()
+            self._sample_change = empty_like(colors)
+            return False
+        subtract(colors, self._last_sample, out=self._sample_change)
+        absolute(self._sample_change, out=self._sample_change)
+        copyto(self._last_sample, colors)
+        self.scene_change = self._sample_change.mean() / 255
+        threshold = (config.sceneCut or {}).get('threshold', 0)
+        return bool(threshold) and self.scene_change > threshold
+
+    def update_idle(self):
+        """
+        idle once the sampled colors changed less than idle.tolerance
+        (mean, 0 - 255) for idle.after seconds. leaves idle as soon as they
+        move more than idle.wake. both compare the scene_change of the raw
+        samples, so gain or brightness do not shift the thresholds.
+        """
+        idle = config.idle or {}
+        tolerance = idle.get('tolerance', 0)
+        change = self.scene_change * 255
+        now = time()
+        if self.idle:
+            if change > idle.get('wake', tolerance):
+                log.debug('colors move again, leave idle')
+                self._set_idle(False)
+                self._still_since = None
+        elif not tolerance or change > tolerance:
+            self._still_since = None
+        elif self._still_since is None:
+            self._still_since = now
+        elif now - self._still_since > idle.get('after', 3):
+            log.debug('colors are still, idle')
+            self._set_idle(True)
+
+    def _set_idle(self, idle):
+        self.idle = idle
+        fps = (config.idle or {}).get('fps', 5)
+        self.camera.set_throttle(1 / fps if idle else 0)
+
     def get_colors(self) -> Iterable[BGRColor]:
         # turn camera on if tv is on, else turn off and wait.
         if not self.tv.is_on:
@@ -231,7 +511,7 @@ class CameraGrabber(ColorGrabber):
                 self.camera.disconnect()
                 self.is_paused = True
             sleep(1)
-            return [(0, 0, 0)] * len(self.indices)
+            return zeros((self.num_leds, 3))
         elif self.is_paused:
             log.debug(
                 '[%s] tv is on. reconnect camera.',
@@ -242,26 +522,78 @@ class CameraGrabber(ColorGrabber):
                 sleep(1)
             self.is_paused = False
 
+        # indices first, they define the band the camera crops to
+        t = time()
+        ys, xs, zones, check_indices, band = self.geometry
         frame = self.camera.get_frame()
-        colors = array([frame[y][x] for y, x in self.indices])
-
-        if config.colors is not None:
-            weights = array([config.colors.get(c, 1) for c in ['blue', 'green', 'red']])
-            weights = weights / weights.max() * config.colors.get('brightness', 1)
-            colors *= weights
-        if config.smoothing and (self._last_colors is not None):
-            colors = (
-                config.smoothing * self._last_colors + (1 - config.smoothing) * colors
-            )
-        self._last_colors = colors
-        self.frame = frame
+        if frame is not None and self.camera.band != band:
+            # the window changed while waiting, the frame has the old crop
+            ys, xs, zones, check_indices, band = self.geometry
+            frame = self.camera.get_frame()
+        if frame is None or self.camera.band != band:
+            # no usable frame from the camera, try again with the next call
+            sleep(0.1)
+            return zeros((len(ys), 3))
+        self.frame_time = self.camera.frame_time
+        t_frame = time()
+        metrics.observe('camera', t_frame - t)
+        if zones is not None:
+            colors = self.sample_zones(frame, zones)
+        else:
+            colors = frame[ys, xs].astype(float)
+        t_sample = time()
+        metrics.observe('sample', t_sample - t_frame)
+        if self._next_recorder is not None:
+            # recordings start from a clean state, so replays can match them
+            self.recorder, self._next_recorder = self._next_recorder, None
+            self.reset_state()
+        if self.auto_wb:
+            self._wb_count += 1
+            if self._wb_count % config.colors.get('wbEvery', 10) == 0:
+                self.update_wb(frame, colors, check_indices)
+        self.scene_cut = self.detect_scene_cut(colors)
+        if self.scene_cut:
+            self.scene_cuts += 1
+            self.pipeline.reset()
+
+        self.update_idle()
+        colors = self.pipeline.process(colors)
+        metrics.observe('process', time() - t_sample)
+        recorder = self.recorder
+        if recorder is not None:
+            try:
+                recorder.write(frame, self.frame_time, colors)
+            except ValueError as e:
+                log.warning('recording stopped: %s', e)
+                self.stop_recording()
+        self.preview.publish(self.camera.raw_frame, self.overlays)
         return colors
 
+    def reset_state(self):
+        "forget smoothing and change detection, the next frame starts fresh"
+        self.pipeline.reset()
+        self._last_sample = None
+        self._still_since = None
+        if self.idle:
+            self._set_idle(False)
+
+    def start_recording(self, filename):
+        "camera band, capture times and led colors of every frame from now on"
+        self.stop_recording()
+        self._next_recorder = Recorder(filename)
+
+    def stop_recording(self):
+        recorder = self.recorder or self._next_recorder
+        self.recorder = self._next_recorder = None
+        if recorder is not None:
+            recorder.close()
+        return recorder
+
     def teardown(self):
+        self.stop_recording()
         self.camera.disconnect()
         self.tv.stop()
-        self._frame = None
-        self._indices = None
+        self.reset_indices()
 
 
 class RainbowGrabber(ColorGrabber):
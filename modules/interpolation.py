@@ -0,0 +1,83 @@
+from numpy import asarray, copyto, multiply, subtract, zeros
+
+MODES = ('linear', 'ease', 'damped')
+
+
+class Interpolator:
+    """
+    moves the output from where it is towards the newest target colors.
+    all buffers are preallocated per led count and updated in place.
+
+    linear / ease: reach the target after `duration` seconds.
+    damped: per led critically damped spring, keeps its velocity across frames.
+    """
+
+    num_leds = None
+
+    def __init__(self, mode='linear'):
+        if mode not in MODES:
+            raise ValueError(f'Unknown interpolation mode: {mode}')
+        self.mode = mode
+        self.duration = 0.1
+        self._t = 0
+
+    def _allocate(self, num_leds):
+        self.output = zeros((num_leds, 3))
+        self.start = zeros((num_leds, 3))
+        self.target = zeros((num_leds, 3))
+        self.delta = zeros((num_leds, 3))
+        self.velocity = zeros((num_leds, 3))
+        self._change = zeros((num_leds, 3))
+        self._scratch = zeros((num_leds, 3))
+        self.num_leds = num_leds
+
+    def set_target(self, colors, duration):
+        colors = asarray(colors)
+        if len(colors) != self.num_leds:
+            self._allocate(len(colors))
+            copyto(self.output, colors)
+        copyto(self.start, self.output)
+        copyto(self.target, colors)
+        subtract(self.target, self.start, out=self.delta)
+        self.duration = max(duration, 1e-3)
+        self._t = 0
+
+    def jump(self, colors):
+        "go to `colors` right away, e.g. on a scene cut"
+        self.set_target(colors, self.duration)
+        copyto(self.output, self.target)
+        self.velocity[:] = 0
+
+    def step(self, t):
+        "output `t` seconds after set_target"
+        dt, self._t = t - self._t, t
+        if self.mode == 'damped':
+            return self._damp(dt)
+        s = min(max(t / self.duration, 0), 1)
+        if self.mode == 'ease':
+            s = s * s * (3 - 2 * s)
+        multiply(self.delta, s, out=self.output)
+        self.output += self.start
+        return self.output
+
+    def _damp(self, dt):
+        # critically damped spring, exponential approximated as in
+        # game programming gems 4, "critically damped ease-in/ease-out smoothing"
+        omega = 4 / self.duration
+        x = omega * dt
+        decay = 1 / (1 + x + 0.48 * x * x + 0.235 * x * x * x)
+        change = self._change
+        subtract(self.output, self.target, out=change)
+        # temp = (velocity + omega * change) * dt, kept in output
+        multiply(change, omega, out=self.output)
+        self.output += self.velocity
+        self.output *= dt
+        # velocity = (velocity - omega * temp) * decay
+        multiply(self.output, omega, out=self._scratch)
+        self.velocity -= self._scratch
+        self.velocity *= decay
+        # output = target + (change + temp) * decay
+        self.output += change
+        self.output *= decay
+        self.output += self.target
+        return self.output
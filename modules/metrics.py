@@ -0,0 +1,71 @@
+from numpy import percentile, zeros
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    "rolling window over the last `size` observations plus running totals"
+
+    def __init__(self, size=1024):
+        self.values = zeros(size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self):
+        if not self.count:
+            return [0.0] * len(QUANTILES)
+        window = self.values[: min(self.count, len(self.values))]
+        return percentile(window, [q * 100 for q in QUANTILES]).tolist()
+
+
+class Metrics:
+    "per stage timings in seconds"
+
+    def __init__(self):
+        self.histograms = {}
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(value)
+
+    def reset(self):
+        self.histograms = {}
+
+    def to_dict(self):
+        result = {}
+        for name, histogram in list(self.histograms.items()):
+            result[name] = dict(
+                count=histogram.count,
+                sum=histogram.sum,
+                **{
+                    f'p{int(q * 100)}': value
+                    for q, value in zip(QUANTILES, histogram.quantiles())
+                },
+            )
+        return result
+
+    def to_prometheus(self):
+        lines = [
+            '# HELP ambicam_stage_seconds time spent per pipeline stage',
+            '# TYPE ambicam_stage_seconds summary',
+        ]
+        for name, histogram in list(self.histograms.items()):
+            for q, value in zip(QUANTILES, histogram.quantiles()):
+                lines.append(
+                    f'ambicam_stage_seconds{{stage="{name}",quantile="{q}"}} {value}'
+                )
+            lines.append(f'ambicam_stage_seconds_sum{{stage="{name}"}} {histogram.sum}')
+            lines.append(
+                f'ambicam_stage_seconds_count{{stage="{name}"}} {histogram.count}'
+            )
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,223 @@
+"""
+color processing after sampling. every stage works in place on one
+preallocated (num_leds, 3) float32 bgr buffer. stage parameters are only
+recomputed when the config was saved or the number of leds changed.
+
+config.pipeline lists the stages, either by name or as dict with parameters:
+    ["gain", {"stage": "saturation", "factor": 1.3}, "ema"]
+"lut" may only come last and replaces "gain". it folds gain and gamma into
+one table lookup and makes the pipeline emit ready to send uint8 colors:
+    ["ema", {"stage": "lut", "gamma": 2.2}]
+"""
+
+from abc import ABC, abstractmethod
+from numpy import (
+    arange,
+    array,
+    clip,
+    copyto,
+    float32,
+    intp,
+    median,
+    multiply,
+    power,
+    take,
+    uint8,
+    zeros,
+)
+from modules.utils import config, config_revision
+
+DEFAULT_STAGES = ['gain', 'ema']
+
+
+class Stage(ABC):
+    def __init__(self, **params):
+        self.params = params
+
+    def configure(self, num_leds):
+        pass
+
+    @abstractmethod
+    def apply(self, buffer):
+        pass
+
+    def reset(self):
+        "forget any state carried between frames"
+        pass
+
+
+def gain_weights():
+    "bgr weights from config.colors and brightness"
+    colors = config.colors or {}
+    weights = array([colors.get(c, 1) for c in ['blue', 'green', 'red']])
+    return weights / weights.max() * colors.get('brightness', 1)
+
+
+class Gain(Stage):
+    "white balance from config.colors and overall brightness"
+
+    def configure(self, num_leds):
+        self.weights = gain_weights().astype(float32)
+
+    def apply(self, buffer):
+        buffer *= self.weights
+
+
+class Gamma(Stage):
+    "perceptual correction for led strips, 255 * (x / 255) ** gamma"
+
+    def configure(self, num_leds):
+        self.gamma = self.params.get('gamma', config.get('gamma', 2.2))
+
+    def apply(self, buffer):
+        buffer *= 1 / 255
+        clip(buffer, 0, 1, out=buffer)
+        power(buffer, self.gamma, out=buffer)
+        buffer *= 255
+
+
+class Saturation(Stage):
+    "moves every led away from its own gray value"
+
+    def configure(self, num_leds):
+        self.factor = self.params.get('factor', 1.2)
+        self.gray = zeros((num_leds, 1), dtype=float32)
+
+    def apply(self, buffer):
+        buffer.mean(axis=1, keepdims=True, out=self.gray)
+        buffer -= self.gray
+        buffer *= self.factor
+        buffer += self.gray
+        clip(buffer, 0, None, out=buffer)
+
+
+class Ema(Stage):
+    "exponential moving average, weight of the past from config.smoothing"
+
+    state = None
+
+    def configure(self, num_leds):
+        self.smoothing = self.params.get('smoothing', config.smoothing or 0)
+        if self.state is None or len(self.state) != num_leds:
+            self.state = zeros((num_leds, 3), dtype=float32)
+            self.empty = True
+
+    def apply(self, buffer):
+        if not self.empty and self.smoothing:
+            buffer *= 1 - self.smoothing
+            multiply(self.state, self.smoothing, out=self.state)
+            buffer += self.state
+        copyto(self.state, buffer)
+        self.empty = False
+
+    def reset(self):
+        self.empty = True
+
+
+class TemporalMedian(Stage):
+    "median of the last `size` frames, removes single frame outliers"
+
+    def configure(self, num_leds):
+        size = self.params.get('size', 3)
+        self.history = zeros((size, num_leds, 3), dtype=float32)
+        self.count = 0
+
+    def apply(self, buffer):
+        self.history[self.count % len(self.history)] = buffer
+        self.count += 1
+        if self.count >= len(self.history):
+            median(self.history, axis=0, out=buffer)
+
+    def reset(self):
+        self.count = 0
+
+
+class BrightnessLimiter(Stage):
+    "scales everything down if the mean level exceeds `max` (0 - 255)"
+
+    def configure(self, num_leds):
+        self.limit = self.params.get('max', 128) * num_leds * 3
+
+    def apply(self, buffer):
+        total = buffer.sum()
+        if total > self.limit:
+            buffer *= self.limit / total
+
+
+class Lut(Stage):
+    """
+    gamma and gain as one 3 x 256 lookup table, emits uint8 in `output`:
+    round(255 * (x / 255) ** gamma * gain) per channel
+    """
+
+    def configure(self, num_leds):
+        gamma = self.params.get('gamma', config.get('gamma', 2.2))
+        levels = power(arange(256) / 255, gamma) * 255
+        table = levels[None, :] * gain_weights()[:, None]
+        self.table = clip(table + 0.5, 0, 255).astype(uint8).ravel()
+        self.offsets = array([0, 256, 512], dtype=intp)
+        self.index = zeros((num_leds, 3), dtype=intp)
+        self.output = zeros((num_leds, 3), dtype=uint8)
+
+    def apply(self, buffer):
+        buffer += 0.5
+        clip(buffer, 0, 255, out=buffer)
+        copyto(self.index, buffer, casting='unsafe')
+        self.index += self.offsets
+        take(self.table, self.index, out=self.output)
+
+
+STAGES = {
+    'gain': Gain,
+    'gamma': Gamma,
+    'saturation': Saturation,
+    'ema': Ema,
+    'median': TemporalMedian,
+    'limiter': BrightnessLimiter,
+    'lut': Lut,
+}
+
+
+class Pipeline:
+    num_leds = None
+    _revision = None
+
+    def __init__(self, stages=None):
+        self.stages = []
+        for stage in stages or config.pipeline or DEFAULT_STAGES:
+            if isinstance(stage, str):
+                stage = {'stage': stage}
+            params = dict(stage)
+            name = params.pop('stage')
+            if name not in STAGES:
+                raise ValueError(f'Unknown pipeline stage: {name}')
+            self.stages.append(STAGES[name](**params))
+        if any(isinstance(stage, Lut) for stage in self.stages[:-1]):
+            raise ValueError('lut has to be the last pipeline stage')
+        if self.stages and isinstance(self.stages[-1], Lut):
+            if any(isinstance(stage, Gain) for stage in self.stages):
+                raise ValueError('lut already applies the gain, remove the gain stage')
+
+    def configure(self, num_leds):
+        self.buffer = zeros((num_leds, 3), dtype=float32)
+        for stage in self.stages:
+            stage.configure(num_leds)
+        self.output = getattr(self.stages[-1], 'output', self.buffer)
+        self.num_leds = num_leds
+        self._revision = config_revision()
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, colors):
+        """
+        runs all stages on a copy of `colors`. returns the reused float32
+        buffer, or the uint8 output of the lut.
+        """
+        if len(colors) != self.num_leds or self._revision != config_revision():
+            self.configure(len(colors))
+        copyto(self.buffer, colors, casting='unsafe')
+        for stage in self.stages:
+            stage.apply(self.buffer)
+        return self.output
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from time import perf_counter as time
+import cv2
+
+
+class Preview:
+    """
+    read only uint8 snapshots of the camera frame for the web preview.
+    the grabber only pays for the copy and the overlays while somebody watches.
+    every snapshot is jpeg encoded at most once, no matter how many viewers.
+    """
+
+    def __init__(self, every=10, fps=3, quality=80):
+        self.every = every
+        self.interval = 1 / fps
+        self.quality = quality
+        self.snapshot = None
+        self.seq = 0
+        self.viewers = 0
+        self._count = 0
+        self._last_publish = 0
+        self._wanted_until = 0
+        self._condition = threading.Condition()
+        self._jpeg = None
+        self._jpeg_seq = 0
+        self._encode_lock = threading.Lock()
+        self._async_waiters = set()
+
+    @property
+    def wanted(self):
+        return self.viewers > 0 or time() < self._wanted_until
+
+    def publish(self, frame, overlays=None):
+        "overlays: callable returning [((left, top, right, bottom), bgr), ...]"
+        self._count += 1
+        if frame is None or self._count % self.every or not self.wanted:
+            return
+        if time() - self._last_publish < self.interval:
+            return
+        self._last_publish = time()
+        snapshot = frame.copy()
+        for (left, top, right, bottom), color in overlays() if overlays else ():
+            cv2.rectangle(snapshot, (left, top), (right, bottom), color, 2)
+        snapshot.setflags(write=False)
+        with self._condition:
+            self.snapshot = snapshot
+            self.seq += 1
+            self._condition.notify_all()
+            for loop, event in self._async_waiters:
+                loop.call_soon_threadsafe(event.set)
+
+    def _request(self, timeout):
+        with self._condition:
+            seq = self.seq
+            self._wanted_until = time() + timeout
+            self._condition.wait_for(lambda: self.seq > seq, timeout)
+            return self.seq, self.snapshot
+
+    def request(self, timeout=1):
+        "wait for a fresh snapshot without subscribing"
+        return self._request(timeout)[1]
+
+    def request_jpeg(self, timeout=1):
+        return self.encode(*self._request(timeout))
+
+    async def frames(self, timeout=1):
+        """
+        async generator of new jpeg snapshots for an event loop viewer.
+        yields None after `timeout` seconds without a new snapshot.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._condition:
+            self.viewers += 1
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                waiter[1].clear()
+                with self._condition:
+                    seq, snapshot = self.seq, self.snapshot
+                if self._jpeg_seq == seq:
+                    yield self._jpeg
+                else:
+                    yield await loop.run_in_executor(None, self.encode, seq, snapshot)
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+                self.viewers -= 1
+
+    def encode(self, seq, snapshot):
+        # the first viewer encodes, everybody else gets the cached bytes
+        if snapshot is None:
+            return None
+        with self._encode_lock:
+            if self._jpeg_seq != seq:
+                ret, buffer = cv2.imencode(
+                    '.jpg', snapshot, [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+                )
+                self._jpeg = buffer.tobytes()
+                self._jpeg_seq = seq
+            return self._jpeg
@@ -0,0 +1,149 @@
+"""
+recordings of what the camera delivered and what the leds got, to replay a
+scene with ReplayCamera (config.cameraInterface "replay") or misc/replay.py.
+
+file layout, little endian:
+    b'AMBIREC1', uint32 header length, json header, padding to 4096 bytes
+    fixed size records: float64 seconds since the first frame,
+    uint8 camera band (as returned by get_frame), float32 (num_leds, 3) bgr
+the header holds the band shape, the led count and the config at the start
+of the recording. records can be memory mapped as one structured array.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+from numpy import dtype, memmap, zeros
+from modules.utils import AttrDict, config
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'AMBIREC1'
+ALIGN = 4096
+
+
+def record_dtype(shape, num_leds):
+    return dtype(
+        [
+            ('time', '<f8'),
+            ('frame', 'u1', tuple(shape)),
+            ('leds', '<f4', (num_leds, 3)),
+        ]
+    )
+
+
+def _data_offset(header_size):
+    return (len(MAGIC) + 4 + header_size + ALIGN - 1) // ALIGN * ALIGN
+
+
+class Recorder:
+    """
+    appends records to `filename`, band shape and led count from the first one.
+    write only copies into one of `buffers` preallocated records, a thread
+    writes them to disk. when the disk falls behind, records are dropped.
+    """
+
+    # records on disk
+    count = 0
+    dropped = 0
+
+    def __init__(self, filename, buffers=8):
+        self.filename = filename
+        self.file = None
+        self.buffers = buffers
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._writer = None
+
+    def _open(self, shape, num_leds):
+        header = json.dumps(
+            {'shape': list(shape), 'num_leds': num_leds, 'config': config}
+        ).encode()
+        self.file = open(self.filename, 'wb')
+        self.file.write(MAGIC + len(header).to_bytes(4, 'little') + header)
+        self.file.write(b' ' * (_data_offset(len(header)) - self.file.tell()))
+        for _ in range(self.buffers):
+            self._free.put(zeros(1, dtype=record_dtype(shape, num_leds)))
+        self.shape = shape
+        self.num_leds = num_leds
+        self._writer = threading.Thread(target=self._write_records, daemon=True)
+        self._writer.start()
+
+    def _write_records(self):
+        while True:
+            record = self._filled.get()
+            if record is None:
+                return
+            try:
+                self.file.write(record.data)
+            except OSError as e:
+                log.error('recording stopped, %s', e)
+                return
+            self.count += 1
+            self._free.put(record)
+
+    def write(self, frame, frame_time, colors):
+        if self.file is None:
+            self._open(frame.shape, len(colors))
+            self.started = frame_time
+        elif frame.shape != self.shape or len(colors) != self.num_leds:
+            raise ValueError('band or led count changed while recording')
+        try:
+            record = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        record['time'][0] = frame_time - self.started
+        record['frame'][0] = frame
+        record['leds'][0] = colors
+        self._filled.put(record)
+
+    def close(self):
+        "waits until the pending records are on disk"
+        if self._writer is not None:
+            self._filled.put(None)
+            self._writer.join()
+        if self.file is not None:
+            self.file.close()
+
+
+class Recording:
+    "a recording file, records memory mapped read only"
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'Not an ambicam recording: {filename}')
+            size = int.from_bytes(f.read(4), 'little')
+            self.header = json.loads(f.read(size), object_hook=AttrDict)
+        self.dtype = record_dtype(self.header['shape'], self.header['num_leds'])
+        offset = _data_offset(size)
+        # a record cut off by a crash is ignored
+        count = max(os.path.getsize(filename) - offset, 0) // self.dtype.itemsize
+        if count:
+            self.records = memmap(
+                filename, dtype=self.dtype, mode='r', offset=offset, shape=(count,)
+            )
+        else:
+            self.records = zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def config(self):
+        return self.header['config']
+
+    @property
+    def times(self):
+        return self.records['time']
+
+    @property
+    def frames(self):
+        return self.records['frame']
+
+    @property
+    def leds(self):
+        return self.records['leds']
@@ -1,17 +1,41 @@
 from abc import ABC, abstractmethod
 from hashlib import new
 import logging
+import os
 from time import sleep, perf_counter as time
 import threading
 from typing import List, Tuple
-from numpy import array, linspace
-from modules.utils import config
+from numpy import (
+    absolute,
+    arange,
+    array,
+    asarray,
+    clip,
+    empty,
+    flatnonzero,
+    intp,
+    take,
+    uint8,
+)
+from modules.adalight import FrameEncoder, frame_interval, latch_time
+from modules.interpolation import Interpolator
+from modules.metrics import metrics
+from modules.udp import ENCODERS
+from modules.utils import config, Handoff
 
 
 log = logging.getLogger()
 
 
 class Connection(ABC, threading.Thread):
+    # seconds the link needs per frame
+    min_interval = 0
+    # the colors are still, send them as they come without interpolating
+    idle = False
+    # upper limit for the frames sent per second, 0 means as fast as the link
+    max_fps = 0
+    num_leds = None
+
     @abstractmethod
     def connect(self, **kwargs):
         "kwargs from config"
@@ -33,56 +57,102 @@ class Connection(ABC, threading.Thread):
         self.last_time = None
         self.dt = 0.1
         self.last_time = time()
-        self.new_colors = None
+        self.handoff = Handoff()
         self.last_command = ''
+        self.fps = 0
+        self._last_send = None
+        self._next_send = 0
+        self._captured = None
+        self._flush = False
 
     def run(self):
         self.running = True
-        last_colors = None
-        new_colors = None
-        smoothing = int(config.fps.get('interpolation'))
+        steps = int(config.fps.get('interpolation') or 0)
+        interpolator = Interpolator(config.fps.get('interpolationMode', 'linear'))
         while self.running:
-            if self.new_colors is None:
-                sleep(0.01)
+            if not self.handoff.wait(timeout=0.5):
+                continue
+            if not steps or self.idle:
+                self.wait_for_link()
+                self._flush = False
+                self._send(self._take())
                 continue
-            if not smoothing:
-                self.send_colors(self.new_colors)
-                last_colors = self.new_colors
-                self.new_colors = None
+            colors = self._take()
+            if self._flush:
+                # scene cut, jump there instead of interpolating
+                self._flush = False
+                interpolator.jump(colors)
+                self.wait_for_link()
+                self._send(interpolator.output)
                 continue
-            _t = time()
-            last_colors = new_colors or self.new_colors
-            new_colors = self.new_colors
-            self.new_colors = None
-            colors_slope = (array(new_colors, float) - array(last_colors, float)) / (
-                self.dt or 0.1
-            )
-            dt_1 = time() - _t
-            for t in linspace(
-                self.dt / smoothing,
-                self.dt,
-                smoothing,
-            ):
-                if self.new_colors:
-                    log.warning('too early! t = %s', t)
+            # spread the steps over the expected time until the next frame
+            interpolator.set_target(colors, self.dt or 0.1)
+            start = time()
+            for i in range(1, steps + 1):
+                deadline = start + interpolator.duration * i / steps
+                if self.handoff.wait(timeout=deadline - time()):
+                    # retarget from wherever the output is now
                     break
-                _colors = last_colors + colors_slope * t
-                dt_2 = self.send_colors(_colors)
-                _sleep = (self.dt - dt_1) / (smoothing + 1) - dt_2
-                if _sleep > 0:
-                    sleep(_sleep)
-                else:
-                    log.warning('too much smoothing')
-        self.send_colors([[0, 0, 0]] * sum(_['leds'] for _ in config.leds))
+                self.wait_for_link()
+                t = time()
+                colors = interpolator.step(t - start)
+                metrics.observe('interpolate', time() - t)
+                self._send(colors)
+        num_leds = self.num_leds or sum(_['leds'] for _ in config.leds)
+        self.send_colors([[0, 0, 0]] * num_leds)
         self.disconnect()
 
+    def wait_for_link(self):
+        # frames arriving meanwhile replace each other, only the newest is sent
+        wait = self._next_send - time()
+        if wait > 0:
+            sleep(wait)
+
+    def _take(self):
+        colors = self.handoff.take()
+        self._captured = self.handoff.stamp
+        metrics.observe('handoff', self.handoff.lag)
+        return colors
+
+    def _send(self, colors):
+        t = time()
+        dt = self.send_colors(colors) or 0
+        metrics.observe('send', time() - t)
+        if self._captured is not None:
+            # capture to bytes written, for the first send of every frame
+            metrics.observe('latency', time() - self._captured)
+            self._captured = None
+        if self._last_send is not None:
+            self.fps = 0.9 * self.fps + 0.1 / max(t - self._last_send, 1e-6)
+        self._last_send = t
+        self._next_send = t + max(
+            self.min_interval, 1 / self.max_fps if self.max_fps else 0
+        )
+        self.num_leds = len(colors)
+        return dt
+
+    def flush(self):
+        "drop the interpolation state, the next frame is sent as it is"
+        self._flush = True
+
+    @property
+    def coalesced(self):
+        return self.handoff.skipped
+
+    @property
+    def lag(self):
+        return self.handoff.lag
+
     def stop(self):
         self.running = False
 
-    def update_colors(self, bgr_colors: List[Tuple[int, int, int]]):
+    def update_colors(
+        self, bgr_colors: List[Tuple[int, int, int]], captured: float = None
+    ):
+        "captured: perf_counter timestamp of the camera frame, for latency"
         self.dt = 0.1 * (time() - self.last_time) + 0.9 * self.dt
         self.last_time = time()
-        self.new_colors = bgr_colors[:]
+        self.handoff.publish(bgr_colors, captured)
 
 
 class DummyConnection(Connection):
@@ -97,17 +167,41 @@ class DummyConnection(Connection):
         print(colors)
 
 
+class NullConnection(Connection):
+    "discards the colors, only counts the frames. for benchmarks."
+
+    frames = 0
+    # optional callable(colors), e.g. for misc/latency.py
+    on_send = None
+
+    def connect(self, **kwargs):
+        self.start()
+
+    def disconnect(self):
+        self.running = False
+
+    def send_colors(self, colors):
+        self.frames += 1
+        if self.on_send is not None:
+            self.on_send(colors)
+
+
 class BridgeConnection(Connection):
     def __init__(self):
         super().__init__()
+        self.encoder = FrameEncoder()
 
     def connect(self, **kwargs):
         import socket
 
         self.host = kwargs.get('host')
         self.port = kwargs.get('port')
+        # baud rate of the serial link behind the bridge
+        self.baudrate = kwargs.get('baudrate', 500000)
 
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # frames are small and latency bound, never wait for more data
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.connection.connect((self.host, self.port))
         self.start()
 
@@ -115,34 +209,115 @@ class BridgeConnection(Connection):
         self.running = False
         self.connection.close()
 
+    @property
+    def min_interval(self):
+        if self.encoder.num_leds is None:
+            return 0
+        return frame_interval(self.encoder.num_leds, self.baudrate)
+
     def send_colors(self, colors):
-        num = len(colors) - 1
-        hi = num >> 8
-        lo = num & 0xFF
-        checksum = hi ^ lo ^ 0x55
+        t = time()
+        self.connection.sendall(self.encoder.encode(colors))
+        return time() - t
+
+
+class SerialConnection(Connection):
+    """
+    writes adalight frames straight to the arduino, without bridge and tcp.
+    writes never block. the next frame waits at least frame_interval, and also
+    until the last one has left the os buffer and the strip latched it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.encoder = FrameEncoder()
+        self._ready = 0
+
+    def connect(self, **kwargs):
+        import serial
+
+        self.port = kwargs.get('port', '/dev/ttyACM0')
+        self.baudrate = kwargs.get('baudrate', 500000)
+        # assumed size of the os output buffer for ports without a file descriptor
+        self.buffer_size = kwargs.get('bufferSize', 4096)
+
+        self.connection = serial.serial_for_url(
+            self.port, baudrate=self.baudrate, timeout=2, write_timeout=0
+        )
+        # opening the port resets the arduino, it says 'Ada' once it listens
+        self.connection.read_until(b'Ada\n')
+        self.connection.reset_input_buffer()
+        self.start()
+
+    def disconnect(self):
+        self.running = False
+        self.connection.close()
+
+    @property
+    def min_interval(self):
+        # lower bound even where out_waiting is not reported, e.g. on a pty
+        if self.encoder.num_leds is None:
+            return 0
+        return frame_interval(self.encoder.num_leds, self.baudrate)
+
+    @property
+    def latch(self):
+        return latch_time(self.encoder.num_leds or 0)
+
+    def wait_for_link(self):
+        drained = False
+        pending = self.connection.out_waiting
+        while pending:
+            sleep(pending * 10 / self.baudrate)
+            pending = self.connection.out_waiting
+            drained = True
+        # just went out or estimated after the last write, then the latch
+        wait = (time() + self.latch if drained else self._ready) - time()
+        if wait > 0:
+            sleep(wait)
+        super().wait_for_link()
+
+    def _write(self, data):
+        """
+        bytes written, 0 if the os buffer is full. pyserial retries a full
+        buffer in a busy loop even with write_timeout=0, so write to the
+        non-blocking descriptor directly where there is one.
+        """
+        fd = getattr(self.connection, 'fd', None)
+        if fd is None:
+            free = self.buffer_size - self.connection.out_waiting
+            return self.connection.write(data[:free]) if free > 0 else 0
         try:
-            header = b'Ada' + bytes([hi, lo, checksum])
-        except ValueError:
-            log.error(
-                'ValueError: num: %s hi: %s lo: %s checksum: %s', num, hi, lo, checksum
-            )
+            return os.write(fd, data)
+        except BlockingIOError:
             return 0
-        payload = bytes(
-            int(item) for color in colors for item in (color[1], color[2], color[0])
-        )
-        self.connection.send(header + payload)
-        sleep(0.04)
+
+    def send_colors(self, colors):
+        t = time()
+        frame = self.encoder.encode(colors)
+        written = self._write(frame)
+        while written < len(frame):
+            # os buffer full, give the line time for half of the rest
+            sleep((len(frame) - written) * 5 / self.baudrate)
+            written += self._write(frame[written:])
+        pending = self.connection.out_waiting
+        self._ready = time() + pending * 10 / self.baudrate + self.latch
+        return time() - t
 
 
 class PrismatikConnection(Connection):
     def __init__(self):
         super().__init__()
+        self._templates = []
+        self._last_rgb = None
 
     def connect(self, **kwargs):
         import telnetlib
 
         self.host = kwargs.get('host')
         self.port = kwargs.get('port')
+        # leds whose channels all moved less than this are not resent
+        self.tolerance = kwargs.get('tolerance', 0)
 
         self.connection = telnetlib.Telnet(self.host, self.port)
         self.connection.write(b'lock\n')
@@ -158,17 +333,165 @@ class PrismatikConnection(Connection):
         self.connection.write(command.encode('ascii') + b'\n')
 
     def send_colors(self, colors):
-        cmd = (
-            'setcolor:'
-            + ';'.join(
-                f'{n}-{int(c[2])},{int(c[1])},{int(c[0])}'
-                for n, c in enumerate(colors, start=1)
-            )
-            + ';'
+        colors = asarray(colors)
+        if colors.dtype != uint8:
+            colors = clip(colors, 0, 255)
+        rgb = colors[:, ::-1].astype(int)
+        if self._last_rgb is None or len(self._last_rgb) != len(rgb):
+            self._templates = [f'{n}-%d,%d,%d;' for n in range(1, len(rgb) + 1)]
+            self._last_rgb = rgb
+            changed = arange(len(rgb))
+        else:
+            delta = absolute(rgb - self._last_rgb).max(axis=1)
+            changed = flatnonzero(delta > self.tolerance)
+            if not len(changed):
+                return 0
+            # only remember what was sent, so slow drifts still add up
+            self._last_rgb[changed] = rgb[changed]
+        templates = self._templates
+        cmd = 'setcolor:' + ''.join(
+            [
+                templates[i] % tuple(c)
+                for i, c in zip(changed.tolist(), rgb[changed].tolist())
+            ]
         )
-        if cmd == self.last_command:
-            return 0
-        self.last_command = cmd
         t = time()
         self.send(cmd)
         return time() - t
+
+
+class UdpConnection(Connection):
+    """
+    udp realtime protocols from modules.udp: ddp (default), e131 or wled.
+    a lost packet only costs its own frame. when the socket buffer is full
+    the rest of the frame is dropped instead of queued behind it.
+    """
+
+    dropped = 0
+
+    def connect(self, **kwargs):
+        import socket
+
+        self.host = kwargs.get('host')
+        protocol = kwargs.get('protocol', 'ddp')
+        if protocol not in ENCODERS:
+            raise ValueError(f'Unknown udp protocol: {protocol}')
+        self.encoder = ENCODERS[protocol](**kwargs)
+        self.port = kwargs.get('port', self.encoder.port)
+
+        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.connection.setblocking(False)
+        self.connection.connect((self.host, self.port))
+        self.start()
+
+    def disconnect(self):
+        self.running = False
+        self.connection.close()
+
+    def send_colors(self, colors):
+        t = time()
+        send = self.connection.send
+        for packet in self.encoder.encode(colors):
+            try:
+                send(packet)
+            except BlockingIOError:
+                self.dropped += 1
+                break
+        return time() - t
+
+
+class MultiConnection:
+    """
+    drives several outputs from one color vector. every output is a normal
+    connection thread behind its own handoff, so a slow link only skips
+    frames and never stalls the others. config.multi.outputs, e.g.:
+        [{"server": "bridge", "host": "...", "port": 8888,
+          "leds": {"from": 0, "to": 120}},
+         {"server": "prismatik", "host": "...", "port": 3636,
+          "leds": [130, 129, 128], "fps": 20}]
+    "leds" is a [from, to) range or a list of led indices, default all.
+    "reverse" flips the order, "fps" limits the frame rate of the output.
+    """
+
+    def __init__(self):
+        self.outputs = []
+        self.indices = []
+        self._buffers = []
+
+    def connect(self, outputs=(), **kwargs):
+        for output in outputs:
+            output = dict(output)
+            server_type = output.pop('server')
+            if server_type not in CONNECTIONS or server_type == 'multi':
+                raise ValueError(f'Unknown server type: {server_type}')
+            leds = output.pop('leds', None)
+            if leds is None:
+                indices = None
+            elif isinstance(leds, dict):
+                indices = arange(leds['from'], leds['to'], dtype=intp)
+            else:
+                indices = array(leds, dtype=intp)
+            if indices is not None and output.pop('reverse', False):
+                indices = indices[::-1].copy()
+            connection = CONNECTIONS[server_type]()
+            connection.max_fps = output.pop('fps', 0)
+            connection.connect(**output)
+            self.outputs.append(connection)
+            self.indices.append(indices)
+            self._buffers.append(None)
+
+    def update_colors(self, bgr_colors, captured=None):
+        colors = asarray(bgr_colors)
+        for i, (output, indices) in enumerate(zip(self.outputs, self.indices)):
+            if indices is None:
+                output.update_colors(colors, captured)
+                continue
+            buffer = self._buffers[i]
+            if buffer is None or buffer.dtype != colors.dtype:
+                buffer = self._buffers[i] = empty((len(indices), 3), colors.dtype)
+            take(colors, indices, axis=0, out=buffer)
+            output.update_colors(buffer, captured)
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
+
+    def stop(self):
+        for output in self.outputs:
+            output.stop()
+
+    @property
+    def idle(self):
+        return all(output.idle for output in self.outputs)
+
+    @idle.setter
+    def idle(self, idle):
+        for output in self.outputs:
+            output.idle = idle
+
+    @property
+    def dt(self):
+        return max((output.dt for output in self.outputs), default=0)
+
+    @property
+    def fps(self):
+        return min((output.fps for output in self.outputs), default=0)
+
+    @property
+    def coalesced(self):
+        return sum(output.coalesced for output in self.outputs)
+
+    @property
+    def lag(self):
+        return max((output.lag for output in self.outputs), default=0)
+
+
+CONNECTIONS = {
+    'prismatik': PrismatikConnection,
+    'bridge': BridgeConnection,
+    'serial': SerialConnection,
+    'udp': UdpConnection,
+    'null': NullConnection,
+    'dummy': DummyConnection,
+    'multi': MultiConnection,
+}
@@ -0,0 +1,139 @@
+"""
+udp realtime led protocols, one datagram per packet:
+    ddp:  10 byte header, 480 leds per packet, port 4048 (wled speaks it too)
+    e131: sacn, 170 leds per universe, port 5568
+    wled: wled realtime dnrgb, 489 leds per packet, port 21324
+all packets are allocated once per led count, encode only writes the colors
+into their payloads and bumps the sequence numbers.
+"""
+
+from abc import ABC, abstractmethod
+from uuid import uuid4
+from numpy import asarray, clip, copyto, empty, frombuffer, take, uint8
+
+# bgr -> rgb
+ORDER = [2, 1, 0]
+
+
+class PacketEncoder(ABC):
+    port = None
+    header_size = 0
+    leds_per_packet = 1
+    num_leds = None
+
+    def __init__(self, **kwargs):
+        self.params = kwargs
+        self.seq = 0
+
+    @abstractmethod
+    def write_header(self, packet, index, start, count, last):
+        pass
+
+    def next_frame(self):
+        "per frame header fields, e.g. sequence numbers"
+        pass
+
+    def _allocate(self, num_leds):
+        self.packets, self.views, self.payloads = [], [], []
+        for start in range(0, num_leds, self.leds_per_packet):
+            count = min(self.leds_per_packet, num_leds - start)
+            packet = bytearray(self.header_size + 3 * count)
+            last = start + count == num_leds
+            self.write_header(packet, len(self.packets), start, count, last)
+            payload = frombuffer(packet, dtype=uint8, offset=self.header_size)
+            self.packets.append(packet)
+            self.views.append(memoryview(packet))
+            self.payloads.append((start, payload.reshape(count, 3)))
+        self._scratch = empty((num_leds, 3))
+        self.num_leds = num_leds
+
+    def encode(self, colors):
+        "list of packets, memoryviews into the preallocated buffers"
+        colors = asarray(colors)
+        if len(colors) != self.num_leds:
+            self._allocate(len(colors))
+        if colors.dtype != uint8:
+            take(colors.astype(float, copy=False), ORDER, axis=1, out=self._scratch)
+            clip(self._scratch, 0, 255, out=self._scratch)
+        for start, payload in self.payloads:
+            stop = start + len(payload)
+            if colors.dtype == uint8:
+                take(colors[start:stop], ORDER, axis=1, out=payload)
+            else:
+                copyto(payload, self._scratch[start:stop], casting='unsafe')
+        self.next_frame()
+        return self.views
+
+
+class DdpEncoder(PacketEncoder):
+    port = 4048
+    header_size = 10
+    leds_per_packet = 480
+
+    def write_header(self, packet, index, start, count, last):
+        # version 1, push on the last packet of a frame
+        packet[0] = 0x41 if last else 0x40
+        # rgb, 8 bit per channel
+        packet[2] = 0x0B
+        # default output device
+        packet[3] = 1
+        packet[4:8] = (3 * start).to_bytes(4, 'big')
+        packet[8:10] = (3 * count).to_bytes(2, 'big')
+
+    def next_frame(self):
+        # 1 - 15, 0 would mean unused
+        self.seq = self.seq % 15 + 1
+        for packet in self.packets:
+            packet[1] = self.seq
+
+
+class E131Encoder(PacketEncoder):
+    port = 5568
+    header_size = 126
+    leds_per_packet = 170
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.cid = uuid4().bytes
+
+    def write_header(self, packet, index, start, count, last):
+        size = len(packet)
+        universe = self.params.get('universe', 1) + index
+        # root layer
+        packet[0:2] = (0x10).to_bytes(2, 'big')
+        packet[4:16] = b'ASC-E1.17\x00\x00\x00'
+        packet[16:18] = (0x7000 | (size - 16)).to_bytes(2, 'big')
+        packet[18:22] = (4).to_bytes(4, 'big')
+        packet[22:38] = self.cid
+        # framing layer
+        packet[38:40] = (0x7000 | (size - 38)).to_bytes(2, 'big')
+        packet[40:44] = (2).to_bytes(4, 'big')
+        packet[44:51] = b'ambicam'
+        packet[108] = self.params.get('priority', 100)
+        packet[113:115] = universe.to_bytes(2, 'big')
+        # dmp layer, start code 0 followed by the dmx slots
+        packet[115:117] = (0x7000 | (size - 115)).to_bytes(2, 'big')
+        packet[117] = 0x02
+        packet[118] = 0xA1
+        packet[121:123] = (1).to_bytes(2, 'big')
+        packet[123:125] = (1 + 3 * count).to_bytes(2, 'big')
+
+    def next_frame(self):
+        self.seq = (self.seq + 1) % 256
+        for packet in self.packets:
+            packet[111] = self.seq
+
+
+class WledEncoder(PacketEncoder):
+    port = 21324
+    header_size = 4
+    leds_per_packet = 489
+
+    def write_header(self, packet, index, start, count, last):
+        # dnrgb, wled falls back to its effects after `timeout` seconds of silence
+        packet[0] = 4
+        packet[1] = self.params.get('timeout', 2)
+        packet[2:4] = start.to_bytes(2, 'big')
+
+
+ENCODERS = {'ddp': DdpEncoder, 'e131': E131Encoder, 'wled': WledEncoder}
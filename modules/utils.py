@@ -1,7 +1,9 @@
 import json
+import os
 import subprocess
 import threading
-from time import sleep
+from time import sleep, perf_counter as time
+from numpy import array, copyto
 
 
 class AttrDict(dict):
@@ -72,16 +74,89 @@ class TV(threading.Thread):
         return False
 
 
-def get_config(filename='config.json'):
+class Handoff:
+    """
+    hands the newest array from one producer thread to one consumer thread.
+    publish copies into one of three preallocated buffers and never blocks on
+    the consumer, take wakes up as soon as something new was published.
+    """
+
+    def __init__(self):
+        self.seq = 0
+        self.skipped = 0
+        # seconds between publish and take of the last item
+        self.lag = 0
+        # stamp published with the last item taken
+        self.stamp = None
+        self._buffers = [None, None, None]
+        self._times = [0, 0, 0]
+        self._stamps = [None, None, None]
+        self._latest = None
+        self._reading = None
+        self._read_seq = 0
+        self._condition = threading.Condition()
+
+    @property
+    def pending(self):
+        return self.seq > self._read_seq
+
+    def publish(self, item, stamp=None):
+        with self._condition:
+            # never overwrite the newest item or the one being consumed
+            slot = next(i for i in range(3) if i not in (self._latest, self._reading))
+            buffer = self._buffers[slot]
+            if buffer is not None and buffer.shape == getattr(item, 'shape', None):
+                copyto(buffer, item, casting='unsafe')
+            else:
+                self._buffers[slot] = array(item)
+            self._times[slot] = time()
+            self._stamps[slot] = stamp
+            self._latest = slot
+            self.seq += 1
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        "True as soon as there is something new to take"
+        with self._condition:
+            return self._condition.wait_for(lambda: self.pending, timeout)
+
+    def take(self, timeout=None):
+        "newest item not taken yet or None after `timeout` seconds"
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.pending, timeout):
+                return None
+            self.skipped += self.seq - self._read_seq - 1
+            self._read_seq = self.seq
+            self._reading = self._latest
+            self.lag = time() - self._times[self._latest]
+            self.stamp = self._stamps[self._latest]
+            return self._buffers[self._latest]
+
+
+def config_file():
+    "the config in use, config.json unless AMBICAM_CONFIG names another"
+    return os.environ.get('AMBICAM_CONFIG', 'config.json')
+
+
+def get_config(filename=None):
+    filename = filename or config_file()
     with open(filename) as f:
         config = json.load(f, object_hook=AttrDict)
     return config
 
 
-def save_config(data=None, filename='config.json'):
+def save_config(data=None, filename=None):
+    global _revision
     data = data or config
-    with open(filename, 'w') as f:
+    with open(filename or config_file(), 'w') as f:
         json.dump(config, f, indent=4)
+    _revision += 1
+
+
+def config_revision():
+    "changes whenever the config is saved, so derived values can be refreshed"
+    return _revision
 
 
 config = get_config()
+_revision = 0
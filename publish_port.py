@@ -5,130 +5,248 @@
 # (C) 2002-2020 Chris Liechti <cliechti@gmx.net>
 #
 # SPDX-License-Identifier:    BSD-3-Clause
-
-import sys
+"""
+forwards adalight frames from tcp clients (BridgeConnection) to the serial
+port of the arduino, and whatever the arduino answers back to the clients.
+
+only complete frames with a valid header reach the serial port, so a client
+reconnecting in the middle of a frame can not garble the strip. while the
+serial port is busy, newer frames replace the waiting one: the latency stays
+at most one frame instead of growing with a backlog when the wifi stutters.
+
+    python publish_port.py /dev/ttyACM0 500000 --localport 7000
+    python publish_port.py /dev/ttyACM0 500000 --client ambicam.local:7000
+"""
+
+import argparse
+import asyncio
+import logging
 import socket
+import sys
+import threading
 import serial
-import serial.threaded
-import time
 
+log = logging.getLogger('publish_port')
 
-class SerialToNet(serial.threaded.Protocol):
-    """serial->socket"""
+# adalight header as in modules/adalight.py, kept standalone so this file
+# runs on the bridge without the rest of ambicam
+MAGIC = b'Ada'
+HEADER_SIZE = 6
 
-    def __init__(self):
-        self.socket = None
 
-    def __call__(self):
-        return self
+class FrameParser:
+    "splits a byte stream into complete adalight frames"
 
-    def data_received(self, data):
-        if self.socket is not None:
-            self.socket.sendall(data)
+    def __init__(self):
+        self.buffer = bytearray()
+        # bytes that did not belong to any valid frame
+        self.skipped = 0
+
+    def feed(self, data):
+        "list of the frames completed by `data`"
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        while True:
+            start = buffer.find(MAGIC)
+            if start < 0:
+                # keep what could be the beginning of the next magic
+                drop = max(len(buffer) - len(MAGIC) + 1, 0)
+                self.skipped += drop
+                del buffer[:drop]
+                return frames
+            if start:
+                self.skipped += start
+                del buffer[:start]
+            if len(buffer) < HEADER_SIZE:
+                return frames
+            hi, lo, checksum = buffer[3], buffer[4], buffer[5]
+            if checksum != hi ^ lo ^ 0x55:
+                # 'Ada' inside the color data, search on after it
+                self.skipped += 1
+                del buffer[:1]
+                continue
+            size = HEADER_SIZE + 3 * ((hi << 8 | lo) + 1)
+            if len(buffer) < size:
+                return frames
+            frames.append(bytes(buffer[:size]))
+            del buffer[:size]
+
+
+class Bridge:
+    def __init__(self, ser):
+        self.ser = ser
+        self.latest = None
+        self.clients = set()
+        self.frames_in = 0
+        self.frames_out = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    @property
+    def stats(self):
+        return (
+            f'frames in={self.frames_in} out={self.frames_out} '
+            f'dropped={self.dropped} skipped bytes={self.skipped}'
+        )
+
+    def publish(self, frame):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = frame
+        self.frames_in += 1
+        self._new.set()
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # more quickly detect peers that are gone without closing the
+        # connection: after 1 second of idle, send keep-alive packets every
+        # second and give up after 3 unanswered ones
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except AttributeError:
+            # not available on windows
+            pass
+        log.info('Connected by %s', peer)
+        parser = FrameParser()
+        self.clients.add(writer)
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for frame in parser.feed(data):
+                    self.publish(frame)
+        except ConnectionError as e:
+            log.error('ERROR: %s', e)
+        finally:
+            # an unfinished frame of a leaving client is never forwarded
+            self.skipped += parser.skipped + len(parser.buffer)
+            self.clients.discard(writer)
+            writer.close()
+            log.info('Disconnected %s', peer)
+
+    async def write_serial(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._new.wait()
+            self._new.clear()
+            frame, self.latest = self.latest, None
+            # blocks until the frame is on the wire, meanwhile frames coalesce
+            await loop.run_in_executor(None, self._write, frame)
+            self.frames_out += 1
+
+    def _write(self, frame):
+        self.ser.write(frame)
+        self.ser.flush()
+
+    def read_serial(self, loop):
+        "thread: arduino -> all clients"
+        while self.ser.is_open:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except serial.SerialException:
+                break
+            if data:
+                loop.call_soon_threadsafe(self._echo, data)
 
+    def _echo(self, data):
+        for writer in self.clients:
+            writer.write(data)
 
-if __name__ == '__main__':  # noqa
-    import argparse
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            log.info(self.stats)
 
+    async def connect(self, host, port):
+        "client mode: keeps one connection to host:port"
+        while True:
+            log.info('Opening connection to %s:%s...', host, port)
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                log.warning('WARNING: %s', e)
+            else:
+                await self.handle_client(reader, writer)
+            # intentional delay on reconnection as client
+            await asyncio.sleep(5)
+
+    async def serve(self, port, stats_interval=0, client=None):
+        "client: 'HOST:PORT' to connect to instead of listening on `port`"
+        self._new = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        threading.Thread(target=self.read_serial, args=(loop,), daemon=True).start()
+        tasks = [self.write_serial()]
+        if stats_interval:
+            tasks.append(self.report(stats_interval))
+        if client:
+            host, client_port = client.rsplit(':', 1)
+            await asyncio.gather(self.connect(host, int(client_port)), *tasks)
+            return
+        server = await asyncio.start_server(self.handle_client, port=port)
+        log.info('Waiting for connections on %s...', port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), *tasks)
+
+
+def main():
     parser = argparse.ArgumentParser(
-        description='Simple Serial to Network (TCP/IP) redirector.',
-        epilog="""\
-NOTE: no security measures are implemented. Anyone can remotely connect
-to this service over the network.
-
-Only one connection at once is supported. When the connection is terminated
-it waits for the next connect.
-""")
-
-    parser.add_argument(
-        'SERIALPORT',
-        help="serial port name")
-
+        description='Adalight frames from TCP/IP to a serial port.',
+        epilog='NOTE: no security measures are implemented. '
+        'Anyone can remotely connect to this service over the network.',
+    )
+    parser.add_argument('SERIALPORT', help='serial port name')
     parser.add_argument(
         'BAUDRATE',
         type=int,
         nargs='?',
         help='set baud rate, default: %(default)s',
-        default=9600)
-
+        default=9600,
+    )
     parser.add_argument(
-        '-q', '--quiet',
-        action='store_true',
-        help='suppress non error messages',
-        default=False)
-
+        '-q', '--quiet', action='store_true', help='suppress non error messages'
+    )
     parser.add_argument(
-        '--develop',
-        action='store_true',
-        help='Development mode, prints Python internals on errors',
-        default=False)
+        '--stats',
+        type=float,
+        default=60,
+        help='seconds between frame statistics, 0 = off, default: %(default)s',
+    )
 
     group = parser.add_argument_group('serial port')
-
-    group.add_argument(
-        "--bytesize",
-        choices=[5, 6, 7, 8],
-        type=int,
-        help="set bytesize, one of {5 6 7 8}, default: 8",
-        default=8)
-
+    group.add_argument('--bytesize', choices=[5, 6, 7, 8], type=int, default=8)
     group.add_argument(
-        "--parity",
+        '--parity',
         choices=['N', 'E', 'O', 'S', 'M'],
         type=lambda c: c.upper(),
-        help="set parity, one of {N E O S M}, default: N",
-        default='N')
-
-    group.add_argument(
-        "--stopbits",
-        choices=[1, 1.5, 2],
-        type=float,
-        help="set stopbits, one of {1 1.5 2}, default: 1",
-        default=1)
-
-    group.add_argument(
-        '--rtscts',
-        action='store_true',
-        help='enable RTS/CTS flow control (default off)',
-        default=False)
-
-    group.add_argument(
-        '--xonxoff',
-        action='store_true',
-        help='enable software flow control (default off)',
-        default=False)
-
-    group.add_argument(
-        '--rts',
-        type=int,
-        help='set initial RTS line state (possible values: 0, 1)',
-        default=None)
-
-    group.add_argument(
-        '--dtr',
-        type=int,
-        help='set initial DTR line state (possible values: 0, 1)',
-        default=None)
+        default='N',
+    )
+    group.add_argument('--stopbits', choices=[1, 1.5, 2], type=float, default=1)
+    group.add_argument('--rtscts', action='store_true', help='RTS/CTS flow control')
+    group.add_argument('--xonxoff', action='store_true', help='software flow control')
+    group.add_argument('--rts', type=int, help='initial RTS line state (0, 1)')
+    group.add_argument('--dtr', type=int, help='initial DTR line state (0, 1)')
 
     group = parser.add_argument_group('network settings')
-
     exclusive_group = group.add_mutually_exclusive_group()
-
     exclusive_group.add_argument(
-        '-P', '--localport',
-        type=int,
-        help='local TCP port',
-        default=7777)
-
+        '-P', '--localport', type=int, default=7777, help='local TCP port'
+    )
     exclusive_group.add_argument(
-        '-c', '--client',
+        '-c',
+        '--client',
         metavar='HOST:PORT',
         help='make the connection as a client, instead of running a server',
-        default=False)
+    )
 
     args = parser.parse_args()
 
-    # connect to serial port
     ser = serial.serial_for_url(args.SERIALPORT, do_not_open=True)
     ser.baudrate = args.BAUDRATE
     ser.bytesize = args.bytesize
@@ -136,95 +254,40 @@ it waits for the next connect.
     ser.stopbits = args.stopbits
     ser.rtscts = args.rtscts
     ser.xonxoff = args.xonxoff
-
     if args.rts is not None:
         ser.rts = args.rts
-
     if args.dtr is not None:
         ser.dtr = args.dtr
-
-    if not args.quiet:
-        sys.stderr.write(
-            '--- TCP/IP to Serial redirect on {p.name}  {p.baudrate},{p.bytesize},{p.parity},{p.stopbits} ---\n'
-            '--- type Ctrl-C / BREAK to quit\n'.format(p=ser))
-
+    # reads return after a short while so the reader thread can end
+    ser.timeout = 0.5
+
+    logging.basicConfig(
+        level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s'
+    )
+    log.info(
+        '--- TCP/IP to Serial redirect on %s %s,%s,%s,%s ---',
+        ser.name,
+        ser.baudrate,
+        ser.bytesize,
+        ser.parity,
+        ser.stopbits,
+    )
     try:
         ser.open()
     except serial.SerialException as e:
-        sys.stderr.write('Could not open serial port {}: {}\n'.format(ser.name, e))
+        log.error('Could not open serial port %s: %s', ser.name, e)
         sys.exit(1)
 
-    ser_to_net = SerialToNet()
-    serial_worker = serial.threaded.ReaderThread(ser, ser_to_net)
-    serial_worker.start()
-
-    if not args.client:
-        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        srv.bind(('', args.localport))
-        srv.listen(1)
+    bridge = Bridge(ser)
     try:
-        intentional_exit = False
-        while True:
-            if args.client:
-                host, port = args.client.split(':')
-                sys.stderr.write("Opening connection to {}:{}...\n".format(host, port))
-                client_socket = socket.socket()
-                try:
-                    client_socket.connect((host, int(port)))
-                except socket.error as msg:
-                    sys.stderr.write('WARNING: {}\n'.format(msg))
-                    time.sleep(5)  # intentional delay on reconnection as client
-                    continue
-                sys.stderr.write('Connected\n')
-                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                #~ client_socket.settimeout(5)
-            else:
-                sys.stderr.write('Waiting for connection on {}...\n'.format(args.localport))
-                client_socket, addr = srv.accept()
-                sys.stderr.write('Connected by {}\n'.format(addr))
-                # More quickly detect bad clients who quit without closing the
-                # connection: After 1 second of idle, start sending TCP keep-alive
-                # packets every 1 second. If 3 consecutive keep-alive packets
-                # fail, assume the client is gone and close the connection.
-                try:
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
-                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
-                    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-                except AttributeError:
-                    pass # XXX not available on windows
-                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            try:
-                ser_to_net.socket = client_socket
-                # enter network <-> serial loop
-                while True:
-                    try:
-                        data = client_socket.recv(1024)
-                        if not data:
-                            break
-                        ser.write(data)                 # get a bunch of bytes and send them
-                    except socket.error as msg:
-                        if args.develop:
-                            raise
-                        sys.stderr.write('ERROR: {}\n'.format(msg))
-                        # probably got disconnected
-                        break
-            except KeyboardInterrupt:
-                intentional_exit = True
-                raise
-            except socket.error as msg:
-                if args.develop:
-                    raise
-                sys.stderr.write('ERROR: {}\n'.format(msg))
-            finally:
-                ser_to_net.socket = None
-                sys.stderr.write('Disconnected\n')
-                client_socket.close()
-                if args.client and not intentional_exit:
-                    time.sleep(5)  # intentional delay on reconnection as client
+        asyncio.run(bridge.serve(args.localport, args.stats, args.client))
     except KeyboardInterrupt:
         pass
+    finally:
+        ser.close()
+        log.info(bridge.stats)
+        log.info('--- exit ---')
+
 
-    sys.stderr.write('\n--- exit ---\n')
-    serial_worker.stop()
+if __name__ == '__main__':
+    main()